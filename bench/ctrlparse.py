@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : ctrlparse.py                                #
+#           Parse time of synthetic /etc/fancontrol     #
+#           files with many fan controls.               #
+#           I. Helwegen 2023                            #
+#########################################################
+
+####################### IMPORTS #########################
+import os
+import sys
+import time
+import argparse
+import tempfile
+import importlib
+import statistics
+#########################################################
+
+####################### GLOBALS #########################
+OPT_FOLDER    = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "opt", "fancontrol")
+DEF_SIZES     = [10, 100, 500, 1000]
+DEF_RUNS      = 20
+FANS_PER_CHIP = 8
+XML_CONTENT   = '<?xml version="1.0" encoding="utf-8"?>\n<settings><farenheit>false</farenheit></settings>\n'
+#########################################################
+
+###################### FUNCTIONS ########################
+
+def synthetic(n):
+    """
+    fancontrol file with n fan controls, FANS_PER_CHIP per hwmon chip.
+    """
+    chips = ["hwmon{}".format(i) for i in range((n + FANS_PER_CHIP - 1) // FANS_PER_CHIP)]
+    fans = ["{}/pwm{}".format(chips[i // FANS_PER_CHIP], i % FANS_PER_CHIP + 1) for i in range(n)]
+    lines = ["# Configuration file generated by pwmconfig, changes will be lost", "INTERVAL=10"]
+    lines.append("DEVPATH=" + " ".join("{}=devices/platform/nct6775.{}".format(chip, 656 + i) for i, chip in enumerate(chips)))
+    lines.append("DEVNAME=" + " ".join("{}=nct6775".format(chip) for chip in chips))
+    lines.append("FCTEMPS=" + " ".join("{}={}/temp{}_input".format(fan, fan.split("/")[0], i % 4 + 1) for i, fan in enumerate(fans)))
+    lines.append("FCFANS=" + " ".join("{}={}".format(fan, fan.replace("pwm", "fan") + "_input") for fan in fans))
+    lines.append("MINTEMP=" + " ".join("{}={}".format(fan, 30 + i % 20) for i, fan in enumerate(fans)))
+    lines.append("MAXTEMP=" + " ".join("{}={}".format(fan, 60 + i % 20) for i, fan in enumerate(fans)))
+    lines.append("MINSTART=" + " ".join("{}=150".format(fan) for fan in fans))
+    lines.append("MINSTOP=" + " ".join("{}=100".format(fan) for fan in fans))
+    lines.append("MINPWM=" + " ".join("{}=0".format(fan) for fan in fans))
+    lines.append("MAXPWM=" + " ".join("{}=255".format(fan) for fan in fans))
+    return "\n".join(lines) + "\n"
+
+def loadHandler(folder, tmpdir):
+    """
+    Imports datahandler from folder, with its files redirected to tmpdir.
+    """
+    sys.path.insert(0, folder)
+    mod = importlib.import_module("datahandler")
+    mod.CTRL_FILENAME = os.path.join(tmpdir, "fancontrol")
+    mod.CPIT_FILENAME = os.path.join(tmpdir, "fancontrol.xml")
+    for name in ["CACHE_FOLDER", "CONF_FILENAME"]:
+        if hasattr(mod, name):
+            setattr(mod, name, os.path.join(tmpdir, "run", os.path.basename(getattr(mod, name))))
+    return mod
+
+def measure(handler, runs):
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        db = handler.getCtrlFile()
+        times.append((time.perf_counter() - start) * 1000)
+    return times, len(db.get("fans", {}))
+
+def main():
+    parser = argparse.ArgumentParser(description = "Parse time of synthetic fancontrol files (ms)")
+    parser.add_argument("-n", "--runs", type = int, default = DEF_RUNS, help = "runs per size")
+    parser.add_argument("-d", "--dir", default = OPT_FOLDER, help = "folder with datahandler.py")
+    parser.add_argument("sizes", nargs = "*", type = int, default = DEF_SIZES, help = "fan controls per file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(os.path.join(tmpdir, "fancontrol.xml"), "w") as f:
+            f.write(XML_CONTENT)
+        with open(os.path.join(tmpdir, "fancontrol"), "w") as f:
+            f.write(synthetic(1))
+        mod = loadHandler(os.path.abspath(args.dir), tmpdir)
+        handler = mod.datahandler()
+        handler()
+
+        print("{:>6} {:>9} {:>9} {:>9} {:>9}".format("fans", "bytes", "median", "min", "max"))
+        for size in args.sizes:
+            content = synthetic(size)
+            with open(mod.CTRL_FILENAME, "w") as f:
+                f.write(content)
+            times, fans = measure(handler, args.runs)
+            if fans != size:
+                print("{:>6} parsed {} fan controls".format(size, fans))
+            print("{:>6} {:>9} {:>9.2f} {:>9.2f} {:>9.2f}".format(size, len(content), statistics.median(times),
+                                                                  min(times), max(times)))
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : startup.py                                  #
+#           Cold start time per verb of fancontrol-cli  #
+#           and fancontrol-logger, as Cockpit runs them.#
+#           I. Helwegen 2023                            #
+#########################################################
+
+####################### IMPORTS #########################
+import os
+import sys
+import time
+import argparse
+import subprocess
+import statistics
+#########################################################
+
+####################### GLOBALS #########################
+OPT_FOLDER    = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "opt", "fancontrol")
+CLI_VERBS     = [[], ["get"], ["gen"], ["fns"], ["tmp"], ["rpm"], ["pwm"], ["all"], ["snap"],
+                 ["mon"], ["ctl", "isactive"]]
+LOGGER_VERBS  = [["status"], ["tail", "--last", "1m"], ["--points", "600"]]
+DEF_RUNS      = 20
+#########################################################
+
+###################### FUNCTIONS ########################
+
+def measure(cmd, runs):
+    """
+    Runs cmd runs times, returns the wall times [ms] and the last exit code.
+    """
+    times = []
+    retcode = 0
+    for i in range(runs):
+        start = time.perf_counter()
+        retcode = subprocess.run(cmd, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL).returncode
+        times.append((time.perf_counter() - start) * 1000)
+    return times, retcode
+
+def report(name, times, retcode):
+    print("{:<32} {:>8.1f} {:>8.1f} {:>8.1f} {:>4}".format(name, statistics.median(times), min(times),
+                                                           max(times), retcode))
+
+def main():
+    parser = argparse.ArgumentParser(description = "Cold start time per verb (ms, wall clock)")
+    parser.add_argument("-n", "--runs", type = int, default = DEF_RUNS, help = "runs per verb")
+    parser.add_argument("-d", "--dir", default = OPT_FOLDER, help = "folder with the scripts")
+    parser.add_argument("-p", "--python", default = sys.executable, help = "python interpreter")
+    parser.add_argument("verbs", nargs = "*", help = "cli verbs to measure (default all)")
+    args = parser.parse_args()
+
+    cli = os.path.join(args.dir, "fancontrol-cli.py")
+    logger = os.path.join(args.dir, "fancontrol-logger.py")
+    jobs = [("python (baseline)", [args.python, "-c", "pass"])]
+    verbs = [verb.split() for verb in args.verbs] if args.verbs else CLI_VERBS
+    jobs += [("cli " + " ".join(verb), [args.python, cli] + verb) for verb in verbs]
+    if not args.verbs:
+        jobs += [("logger " + " ".join(verb), [args.python, logger] + verb) for verb in LOGGER_VERBS]
+
+    print("{:<32} {:>8} {:>8} {:>8} {:>4}".format("command", "median", "min", "max", "rc"))
+    for name, cmd in jobs:
+        measure(cmd, 1) # warm the page cache and __pycache__
+        times, retcode = measure(cmd, args.runs)
+        report(name, times, retcode)
+
+######################### MAIN ##########################
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,9 @@ class fcMonitor {
         this.stopButton = null;
         this.pane = new tabPane(this, el, this.name);
         this.refresh = 1000;
+        this.graphPoints = 600;
+        this.graphData = null;
+        this.cursor = null;
         this.ctrl = "";
     }
 
@@ -41,6 +44,48 @@ class fcMonitor {
         this.getData();
     }
 
+    refreshGraph(text = "") {
+        var cb = function(data, status) {
+            if (status == 0) {
+                var tData = JSON.parse(data);
+                var tSettings = tData.settings || {};
+                var gSettings = this.graphData.settings || {};
+                if ((tSettings.fancontrol != gSettings.fancontrol) || (tSettings.farenheit != gSettings.farenheit) || ('segments' in tData)) {
+                    this.displayGraph(text);
+                    return;
+                }
+                if ('segments' in this.graphData) {
+                    // appended rows are of the last segment
+                    let segment = this.graphData.segments.length - 1;
+                    tData.data.forEach(datum => datum.segment = segment);
+                }
+                let rows = this.graphData.data.concat(tData.data);
+                if (tData.oldest != undefined) {
+                    // the graph shows the whole log, drop the rows trimmed from it since
+                    rows = rows.filter(datum => datum.time >= tData.oldest);
+                }
+                if (rows.length > this.graphPoints) {
+                    // over the point budget, have the logger downsample again
+                    this.displayGraph(text);
+                    return;
+                }
+                this.graphData.data = rows;
+                this.cursor = tData.cursor;
+            }
+            this.pane.dispose();
+            this.pane.build(text, false, true);
+            this.displayButtons(false);
+            this.buildGraph(this.graphData);
+        }
+        if ((!this.graphData) || (!this.cursor) || ('aggregate' in (this.graphData.settings || {}))) {
+            // raw rows cannot be appended to downsampled buckets, read them again
+            this.displayGraph(text);
+        } else {
+            this.update = {};
+            runLog.call(this, cb, ["tail", "--after", this.cursor].concat(this.getChannel()));
+        }
+    }
+
     getSettings(callback) {
         var cb = function(data) {
             var fData = JSON.parse(data);
@@ -62,7 +107,7 @@ class fcMonitor {
                 this.pane.addButton("graph", "Log graph", this.displayGraph, true, false, false);
             } else {
                 this.pane.addButton("monitor", "Monitor", this.displayMonitor, true, false, false);
-                this.pane.addButton("refresh", "Refresh", this.displayGraph, false, false, false);
+                this.pane.addButton("refresh", "Refresh", this.refreshGraph, false, false, false);
             }
             this.startButton = this.pane.addButton("start", "Start logging", this.startLogging, false, running, false);
             this.stopButton = this.pane.addButton("stop", "Stop logging", this.stopLogging, false, !running, false);
@@ -90,7 +135,7 @@ class fcMonitor {
             }]);
         }
         this.update = {};
-        runCmd.call(this, cb, [this.ctrl]);
+        runRpc.call(this, cb, "monitor", [this.ctrl], [this.ctrl]);
     }
 
     setTimer() {
@@ -225,11 +270,13 @@ class fcMonitor {
         var cb = function(data, status) {
             if (status == 0) {
                 var iData = JSON.parse(data);
+                this.graphData = iData;
+                this.cursor = iData.cursor;
                 this.buildGraph(iData);
             }
         }
         this.update = {};
-        runLog.call(this, cb);
+        runLog.call(this, cb, ["--points", this.graphPoints.toString()].concat(this.getChannel()));
     }
 
     buildGraph(iData) {
@@ -268,6 +315,13 @@ class fcMonitor {
                 data: lData.ctrl
             }]
         };
+        if ('tempMin' in lData) {
+            // min/max of the downsampled buckets as a band around the averages, so peaks remain visible
+            data.datasets.push(this.getBand('temp', 'rgba(255, 99, 132, 0.2)', lData.tempMin, false));
+            data.datasets.push(this.getBand('temp', 'rgba(255, 99, 132, 0.2)', lData.tempMax, '-1'));
+            data.datasets.push(this.getBand('ctrl', 'rgba(70, 130, 180, 0.2)', lData.ctrlMin, false));
+            data.datasets.push(this.getBand('ctrl', 'rgba(70, 130, 180, 0.2)', lData.ctrlMax, '-1'));
+        }
         const config = {
             type: 'line',
             data: data,
@@ -275,6 +329,13 @@ class fcMonitor {
                 responsive: true,
                 maintainAspectRatio: true,
                 aspectRatio: 2.5,
+                plugins: {
+                    legend: {
+                        labels: {
+                            filter: item => item.datasetIndex < 2
+                        }
+                    }
+                },
                 scales: {
                     x: {
                         type: 'linear',
@@ -316,6 +377,19 @@ class fcMonitor {
         var myChart = new Chart(this.pane.getCanvas().getCanvas(), config);
     }
 
+    getBand(axis, color, values, fill) {
+        return {
+            label: "",
+            yAxisID: axis,
+            backgroundColor: color,
+            borderWidth: 0,
+            pointRadius: 0,
+            pointHitRadius: 0,
+            fill: fill,
+            data: values
+        };
+    }
+
     processData(iData) {
         var tmStart = 0;
         var tmMax = 0;
@@ -324,10 +398,24 @@ class fcMonitor {
         var timeData = [];
         var tempData = [];
         var ctrlData = [];
+        // min/max per bucket of downsampled rows, the value itself for raw rows
+        var tempMin = [];
+        var tempMax = [];
+        var ctrlMin = [];
+        var ctrlMax = [];
+        var envelope = false;
         var first = true;
+        // rows of earlier segments may be in another temperature unit
+        var segments = iData.segments || [];
+        var segment = -1;
+        var farenheit = ('settings' in iData) ? iData.settings.farenheit : undefined;
 
         if ('data' in iData) {
             iData.data.forEach(datum => {
+                if (segments.length > 0) {
+                    // rows without an index are of the first segment
+                    segment = ('segment' in datum) ? datum.segment : 0;
+                }
                 if ('time' in datum) {
                     let tmCur = parseInt(datum.time);
                     if (first) {
@@ -344,10 +432,25 @@ class fcMonitor {
                     }
                 }
                 if ('temp' in datum) {
-                    tempData.push(parseFloat(datum.temp));
+                    let convert = (segment >= 0) && (farenheit != undefined) && (segments[segment].settings.farenheit != farenheit);
+                    let toUnit = function(temp) {
+                        temp = parseFloat(temp);
+                        if (convert) {
+                            temp = farenheit ? temp * 9 / 5 + 32 : (temp - 32) * 5 / 9;
+                        }
+                        return temp;
+                    };
+                    tempData.push(toUnit(datum.temp));
+                    tempMin.push(toUnit(('tempmin' in datum) ? datum.tempmin : datum.temp));
+                    tempMax.push(toUnit(('tempmax' in datum) ? datum.tempmax : datum.temp));
                 }
                 if ('rpm' in datum) {
                     ctrlData.push(parseFloat(datum.rpm));
+                    ctrlMin.push(parseFloat(('rpmmin' in datum) ? datum.rpmmin : datum.rpm));
+                    ctrlMax.push(parseFloat(('rpmmax' in datum) ? datum.rpmmax : datum.rpm));
+                }
+                if (('tempmin' in datum) || ('rpmmin' in datum)) {
+                    envelope = true;
                 }
                 /*if ('pwm' in datum) {
                     ctrlData.push(parseFloat(datum.pwm));
@@ -364,10 +467,25 @@ class fcMonitor {
         lData.time = timeData;
         lData.temp = tempData;
         lData.ctrl = ctrlData;
+        if (envelope) {
+            lData.tempMin = tempMin;
+            lData.tempMax = tempMax;
+            lData.ctrlMin = ctrlMin;
+            lData.ctrlMax = ctrlMax;
+        }
 
         return lData;
     }
 
+    getChannel() {
+        // graph the monitored fan control, the logger may log more
+        var args = [];
+        if (this.ctrl) {
+            args = ["--channel", this.ctrl];
+        }
+        return args;
+    }
+
     getCtrl(fData) {
         var ctrl = "";
         var ctrlOpts = [];
@@ -840,13 +958,67 @@ class fcSettings {
                 text: "Logger interval [s]",
                 value: aData.loggerinterval,
                 type: "number",
-                min: 0,
+                min: 0.1,
                 max: 86400,
+                step: 0.1,
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "Defines the interval between log samples in seconds, fractions down to 0.1 seconds are allowed. (default = 60 seconds)"
+            }, {
+                param: "loggerpolicy",
+                text: "Logger missed samples",
+                value: aData.loggerpolicy,
+                type: "select",
+                opts: ["skip", "catchup"],
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "Defines what happens to samples that are missed, e.g. when a driver stalls. Skip continues at the next sample time, catchup takes the missed samples directly. (default = skip)"
+            }, {
+                param: "loggerchannels",
+                text: "Logger fan controls",
+                value: aData.loggerchannels,
+                type: "select",
+                opts: ["", "all"],
+                optslabel: ["Default fan control", "All fan controls"],
+                labelvalue: true,
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "Defines whether the logger logs the default fan control or all fan controls in every sample. (default = default fan control)"
+            }, {
+                param: "loggerflush",
+                text: "Logger flush interval [s]",
+                value: aData.loggerflush,
+                type: "number",
+                min: 0,
+                max: 3600,
                 step: 1,
                 onchange: settingsCallback,
                 disabled: false,
                 readonly: false,
-                comment: "Defines the interval between log samples in seconds. (default = 60 seconds)"
+                comment: "Defines how long log samples are kept in memory before they are written to disk, 0 writes every sample. The graph shows samples that are not written yet. (default = 60 seconds)"
+            }, {
+                param: "loggersync",
+                text: "Logger sync",
+                value: aData.loggersync,
+                type: "select",
+                opts: ["none", "flush", "always"],
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "Defines whether written samples are synced to disk. None leaves it to the system, flush syncs every write, always writes and syncs every sample. (default = none)"
+            }, {
+                param: "loggerformat",
+                text: "Logger format",
+                value: aData.loggerformat,
+                type: "select",
+                opts: ["text", "binary"],
+                onchange: settingsCallback,
+                disabled: false,
+                readonly: false,
+                comment: "Defines the format of the log file. Binary is compact and faster to read for long histories. (default = text)"
             }, {
                 param: "farenheit",
                 text: "Farenheit",
@@ -883,6 +1055,8 @@ class fcSettings {
             var txt = "Are you sure to update settings?"
             if ("interval" in this.update) {
                 txt = "Are you sure to update settings and restart fancontrol services?"
+            } else if (Object.keys(this.update).some(key => (key == "farenheit") || key.startsWith("logger"))) {
+                txt = "Are you sure to update settings and reload the logger?"
             }
             new confirmDialog(this, "Update settings", txt, cbYes);
         } else {
@@ -913,6 +1087,43 @@ function runCmd(callback, args = [], json = null, cmd = "/opt/fancontrol/fancont
         .fail(cbFail.bind(this));
 }
 
+function runRpc(callback, method, params = [], args = [], path = "/run/fancontrol/fancontrol.sock") {
+    // query the rpc server directly, fall back to spawning the cli when it is not running
+    var buffer = "";
+    var done = false;
+    var cbFallback = function() {
+        if (!done) {
+            done = true;
+            runCmd.call(this, callback, args);
+        }
+    };
+    var cbMessage = function(event, data) {
+        buffer += data;
+        var pos = buffer.indexOf("\n");
+        if ((pos >= 0) && (!done)) {
+            var response = {};
+            try {
+                response = JSON.parse(buffer.substring(0, pos));
+            } catch (e) {
+                response = {};
+            }
+            if ("result" in response) {
+                // close dispatches "close" synchronously, so mark done first
+                done = true;
+                channel.close();
+                callback.call(this, JSON.stringify(response.result));
+            } else {
+                channel.close();
+            }
+        }
+    };
+    var channel = cockpit.channel({ payload: "stream", unix: path, superuser: "require" });
+    channel.addEventListener("message", cbMessage.bind(this));
+    channel.addEventListener("close", cbFallback.bind(this));
+    channel.send(JSON.stringify({ id: 1, method: method, params: params }) + "\n");
+    return channel;
+}
+
 function runLog(callback, args = [], cmd = "/opt/fancontrol/fancontrol-logger.py") {
     var cbDone = function(data) {
         callback.call(this, data, 0);
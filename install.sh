@@ -9,6 +9,9 @@ USRLOC="$USRDIR/$CKPTDIR/$NAME"
 DEBFOLDER="debian"
 OPTLOC="$OPTDIR/$NAME"
 OPTCLI="$OPTLOC/$CLINAME"
+SYSTEMDLOC="/lib/systemd/system"
+RPCSERVICE="$NAME-rpc.service"
+LOGSERVICE="$NAME-logger.service"
 
 minify_install () {
     echo "Installing and compiling files"
@@ -49,6 +52,16 @@ then
     if [ -d "$OPTCLI" ]; then
         rm -f "$OPTCLI"
     fi
+    if [ -f "$SYSTEMDLOC/$RPCSERVICE" ]; then
+        systemctl disable --now "$RPCSERVICE"
+        rm -f "$SYSTEMDLOC/$RPCSERVICE"
+        systemctl daemon-reload
+    fi
+    if [ -f "$SYSTEMDLOC/$LOGSERVICE" ]; then
+        systemctl disable --now "$LOGSERVICE"
+        rm -f "$SYSTEMDLOC/$LOGSERVICE"
+        systemctl daemon-reload
+    fi
 
 elif [ "$1" == "-h" ] || [ "$1" == "-H" ]
 then
@@ -93,19 +106,13 @@ else
         cp -r ".$OPTLOC/." "$OPTLOC/"
     fi
 
-    echo "Checking and installing required PIP packages"
+    echo "Installing and starting rpc service"
+    cp ".$SYSTEMDLOC/$RPCSERVICE" "$SYSTEMDLOC/"
+    systemctl daemon-reload
+    systemctl enable "$RPCSERVICE"
+    systemctl restart "$RPCSERVICE"
 
-    PKG_OK=$(dpkg-query -W --showformat='${Status}\n' python3-pip|grep "install ok installed")
-    echo Checking for pip3: $PKG_OK
-    if [ "" == "$PKG_OK" ]; then
-        echo "No pip3. Setting up pip3."
-        sudo apt-get --force-yes --yes install python3-pip
-    fi
-
-    PKG_OK=$(sudo -H pip3 freeze| grep -i "psutil==")
-    echo Checking for psutil: $PKG_OK
-    if [ "" == "$PKG_OK" ]; then
-        echo "No psutil. Setting up psutil."
-        sudo -H pip3 install psutil
-    fi
+    echo "Installing logger service (enable to log from boot)"
+    cp ".$SYSTEMDLOC/$LOGSERVICE" "$SYSTEMDLOC/"
+    systemctl daemon-reload
 fi
@@ -10,29 +10,169 @@
 
 ####################### IMPORTS #########################
 import os
-import xml.etree.ElementTree as ET
-from xml.dom.minidom import parseString
+import time
+import json
+from hwmonhandler import hwmonindex, hwmonpool, hwmonplan, hwmonalarms, HWMON_FOLDER, SYS_FOLDER
 #########################################################
 
 ####################### GLOBALS #########################
 ETC_LOC       = "/etc"
 CTRL_FILENAME = "/etc/fancontrol"
 CPIT_FILENAME = "/etc/fancontrol.xml"
+CACHE_FOLDER  = "/run/fancontrol"
+CONF_FILENAME = "/run/fancontrol/config.json"
+CONF_VERSION  = 1
+CTRL_TEXT     = 0
+CTRL_NUMBER   = 1
+CTRL_TEMP     = 2
+CTRL_KEYS     = {"INTERVAL": ("", "interval", CTRL_NUMBER), # keyword: section, param, type
+                 "DEVPATH":  ("devices", "devpath", CTRL_TEXT),
+                 "DEVNAME":  ("devices", "devname", CTRL_TEXT),
+                 "FCTEMPS":  ("fans", "temp", CTRL_TEXT),
+                 "FCFANS":   ("fans", "fan", CTRL_TEXT),
+                 "MINTEMP":  ("fans", "mintemp", CTRL_TEMP),
+                 "MAXTEMP":  ("fans", "maxtemp", CTRL_TEMP),
+                 "MINSTART": ("fans", "minstart", CTRL_NUMBER),
+                 "MINSTOP":  ("fans", "minstop", CTRL_NUMBER),
+                 "MINPWM":   ("fans", "minpwm", CTRL_NUMBER),
+                 "MAXPWM":   ("fans", "maxpwm", CTRL_NUMBER)}
+ALARM_ATTRS   = [("temp", "_alarm", "Temperature alarm"), # input, suffix, text
+                 ("temp", "_crit_alarm", "Temperature critical"),
+                 ("fan", "_alarm", "Fan alarm")]
 ENCODING      = 'utf-8'
-DEF_SETTINGS  = {"farenheit": False, "logger": None, "loggerinterval": 60, "names": {}}
-HWMON_FOLDER  = "/sys/class/hwmon"
-SYS_FOLDER    = "/sys"
-HWMON_SUB     = "hwmon"
+DEF_SETTINGS  = {"farenheit": False, "logger": None, "loggerinterval": 60, "loggerformat": "text",
+                 "loggerpolicy": "skip", "loggerchannels": "", "loggerflush": 60,
+                 "loggersync": "none", "names": {}}
 #########################################################
 
 ###################### FUNCTIONS ########################
 
+def splitloc(loc):
+    # "hwmon2/pwm1" -> ("hwmon2", "pwm1"), None if not a location
+    try:
+        hwmon, attr = loc.split("/", 1)
+    except:
+        return None
+    return hwmon, attr
+
+#########################################################
+# Class : device                                        #
+#########################################################
+class device(object):
+    __slots__ = ("hwmon", "devpath", "devname")
+
+    def __init__(self, hwmon, data = {}):
+        self.hwmon = hwmon
+        self.devpath = data.get("devpath", "")
+        self.devname = data.get("devname", "")
+
+#########################################################
+# Class : fancontrol                                    #
+#########################################################
+class fancontrol(object):
+    """
+    A fan control of the config. The pwm output, temperature and fan
+    input are split once in (hwmon, attribute), None if not set.
+    """
+    __slots__ = ("ctrl", "hwmon", "pwm", "temp", "fan", "mintemp", "maxtemp",
+                 "minstart", "minstop", "minpwm", "maxpwm", "name")
+
+    def __init__(self, ctrl, data = {}):
+        self.ctrl = ctrl
+        self.hwmon = ctrl.split("/", 1)[0]
+        self.pwm = splitloc(ctrl)
+        self.temp = splitloc(data.get("temp"))
+        self.fan = splitloc(data.get("fan"))
+        self.mintemp = data.get("mintemp")
+        self.maxtemp = data.get("maxtemp")
+        self.minstart = data.get("minstart")
+        self.minstop = data.get("minstop")
+        self.minpwm = data.get("minpwm")
+        self.maxpwm = data.get("maxpwm")
+        self.name = data.get("name", "")
+
+    def location(self, key = ""):
+        # (hwmon, attribute) of the pwm output (""), "temp" or "fan"
+        return getattr(self, key) if key else self.pwm
+
+#########################################################
+# Class : settings                                      #
+#########################################################
+class settings(object):
+    """
+    Typed model of the config, built from the dict view (datahandler.db)
+    for the paths that run on every sample. devices and fans are
+    {hwmon: device} and {ctrl: fancontrol}.
+    """
+    __slots__ = ("farenheit", "logger", "interval", "devices", "fans")
+
+    def __init__(self, db = {}):
+        self.farenheit = bool(db.get("farenheit", False))
+        self.logger = db.get("logger")
+        self.interval = db.get("interval", 0)
+        self.devices = {hwmon: device(hwmon, data) for hwmon, data in db.get("devices", {}).items()}
+        self.fans = {ctrl: fancontrol(ctrl, data) for ctrl, data in db.get("fans", {}).items()}
+
 #########################################################
 # Class : datahandler                                   #
 #########################################################
 class datahandler(object):
+    """
+    Settings of fancontrol and cockpit-fancontrol, and the hwmon sensors.
+    Both load on first use: the config files are read (or the xml created)
+    when the data is used and the hwmon topology is scanned when a sensor
+    or device is used. So topology only verbs (sensors, hwmon devices) do
+    not read the config, and config only verbs do not scan hwmon.
+    The parsed config is cached under /run, keyed by the stamps of both
+    config files, and only parsed again when one of them changed.
+    db is the config as dict, for JSON and updates, getConfig() the typed
+    model of it, which is rebuilt when db changes.
+    After watchAlarms(), alarms are kept in memory and updated by
+    pollAlarms(), samples then take them from memory instead of sysfs.
+    """
     def __init__(self):
+        self._db = None
+        self.config = None
+        self.comments = None
+        self.hwmon = hwmonindex()
+        self.pool = hwmonpool()
+        self.plans = {}
+        self.plangen = None
+        self.alarms = None
+        self.transitions = {}
+
+    def __del__(self):
+        self.closePlans()
+        if self.alarms:
+            self.alarms.close()
+        del self.db
         self.db = {}
+
+    def __call__(self):
+        return self.db
+
+    @property
+    def db(self):
+        if self._db == None:
+            self.load()
+        return self._db
+
+    @db.setter
+    def db(self, db):
+        self._db = db
+        self.config = None
+
+    @db.deleter
+    def db(self):
+        self._db = None
+        self.config = None
+
+    def getConfig(self):
+        if self.config == None:
+            self.config = settings(self.db)
+        return self.config
+
+    def load(self):
         if not self.getPath(False):
             print("Fancontrol file not found. Please install fancontrol and run pwmconfig from command line.")
             print("pwmconfig finds fans and inputs and automatically configurate fans.")
@@ -42,23 +182,22 @@ class datahandler(object):
             self.createXML()
         self.getDataFile()
 
-    def __del__(self):
-        del self.db
-        self.db = {}
-
-    def __call__(self):
-        return self.db
-
     def update(self, nr = 0):
-        self.updateDataFile(nr)
+        # returns the files that changed on disk (1 = xml, 2 = fancontrol)
+        return self.updateDataFile(nr)
 
     def getUpdate(self, opts):
+        self.closePlans()
+        self.config = None
         return self.findUpdate(opts)
 
     def delCtrl(self, ctrl):
+        self.closePlans()
+        self.config = None
         return self.doDel(ctrl)
 
     def reload(self):
+        self.closePlans()
         del self.db
         self.db = {}
         self.getDataFile()
@@ -66,68 +205,109 @@ class datahandler(object):
     def getControls(self):
         return self.findControls()
 
+    def getStamp(self):
+        # (inode, size, mtime) of the config files, changes when one is written
+        stamp = []
+        for path in [CTRL_FILENAME, CPIT_FILENAME]:
+            try:
+                st = os.stat(path)
+                stamp.append([st.st_ino, st.st_size, st.st_mtime_ns])
+            except:
+                stamp.append(None)
+        return stamp
+
+    def watchAlarms(self):
+        # returns the alarm watcher, its fileno() is readable on an alarm
+        if not self.alarms:
+            self.alarms = hwmonalarms()
+            self.closePlans()
+        return self.alarms
+
+    def pollAlarms(self, timeout = 0):
+        # returns {ctrl: alarm} of the fan controls of which an alarm changed
+        changed = {}
+        if self.alarms:
+            self.hwmon()
+            if self.plangen != self.hwmon.generation:
+                self.closePlans()
+            if not self.alarms.isWatching():
+                self.alarms.watch({ctrl: self.getAlarms(ctrl) for ctrl in self.getConfig().fans})
+            for ctrl in self.alarms.poll(timeout):
+                changed[ctrl] = self.getAlarmText(self.alarms.get(ctrl))
+            self.transitions.update(changed)
+        return changed
+
+    def getTransitions(self):
+        # {ctrl: alarm} changed since the last call, also when polled by monitor or snapshot
+        transitions = self.transitions
+        self.transitions = {}
+        return transitions
+
+    def getAlarmState(self):
+        # {ctrl: alarm} of all fan controls, from memory when watched
+        if not self.alarms:
+            return {ctrl: val['alarm'] for ctrl, val in self.snapshot()['fans'].items()}
+        self.pollAlarms()
+        return {ctrl: self.getAlarmText(self.alarms.get(ctrl)) for ctrl in self.getConfig().fans}
+
     def monitor(self, ctrl = None):
         val = {}
-        ctrls = self.getControls()
-        if (not ctrl) and ctrls:
-            ctrl = list(ctrls.keys())[0]
-        if ctrl in ctrls:
+        self.pollAlarms()
+        config = self.getConfig()
+        if (not ctrl) and config.fans:
+            ctrl = next(iter(config.fans))
+        if ctrl in config.fans:
             val['ctrl'] = ctrl
-            val['farenheit'] = self.db['farenheit']
-            val['temp'] = self.getMonValue(ctrl, "temp")
-            val['rpm'] = self.getMonValue(ctrl, "fan")
-            val['pwm'] = self.getMonValue(ctrl)
-            val['alarm'] = self.getAlarms(ctrl, "temp", "fan")
+            val['farenheit'] = config.farenheit
+            val.update(self.getSample(self.getPlan(ctrl)))
         return val
 
+    def snapshot(self, ctrls = None):
+        # all (or the ctrls) fan controls in one pass, every attribute is read once
+        snap = {}
+        self.pollAlarms()
+        config = self.getConfig()
+        fans = config.fans
+        plans = [self.getPlan(ctrl) for ctrl in (ctrls if ctrls != None else fans) if ctrl in fans]
+        fds = set()
+        for plan in plans:
+            fds.update(plan.fds())
+        values = self.pool.readAll(fds)
+        snap['time'] = round(time.time(), 3)
+        snap['farenheit'] = config.farenheit
+        snap['fans'] = {plan.ctrl: self.getSample(plan, values) for plan in plans}
+        return snap
+
     def getTempSensors(self):
         sensors = {}
-        devices = self.getDevices()
-        for hwmon in devices.keys():
-            loc = self.getLocation("", hwmon)
-            if loc:
-                devlst = os.listdir(loc)
-                for dev in devlst:
-                    if dev.startswith("temp") and dev.endswith("_input"):
-                        name = self.readDevFile(os.path.join(loc, dev.replace("_input","_label")))
-                        sensors[hwmon + "/" + dev] = devices[hwmon]["devname"] + ":" + name
+        for hwmon, chip in self.hwmon().items():
+            for dev, name in chip.temps.items():
+                sensors[hwmon + "/" + dev] = chip.devname + ":" + name
         return sensors
 
     def getFanInputs(self):
         sensors = {}
-        devices = self.getDevices()
-        for hwmon in devices.keys():
-            loc = self.getLocation("", hwmon)
-            if loc:
-                devlst = os.listdir(loc)
-                for dev in devlst:
-                    if dev.startswith("fan") and dev.endswith("_input"):
-                        sensors[hwmon + "/" + dev] = devices[hwmon]["devname"] + ":" + dev.replace("_input","")
+        for hwmon, chip in self.hwmon().items():
+            for dev in chip.fans:
+                sensors[hwmon + "/" + dev] = chip.devname + ":" + dev.replace("_input","")
         return sensors
 
     def getPWMs(self):
         sensors = {}
-        devices = self.getDevices()
-        for hwmon in devices.keys():
-            loc = self.getLocation("", hwmon)
-            if loc:
-                devlst = os.listdir(loc)
-                for dev in devlst:
-                    if dev.startswith("pwm") and not "_" in dev:
-                        sensors[hwmon + "/" + dev] = devices[hwmon]["devname"] + ":" + dev
+        for hwmon, chip in self.hwmon().items():
+            for dev in chip.pwms:
+                sensors[hwmon + "/" + dev] = chip.devname + ":" + dev
         return sensors
 
     def getHwMon(self, hwmon):
         dev = {}
         devices = self.getDevices()
         if hwmon in devices.keys():
-            dev = devices[hwmon] # get devPath, devName
+            dev = dict(devices[hwmon]) # get devPath, devName
         return dev
 
     def getLogger(self):
-        logger = ""
-        if "logger" in self.db:
-            logger = self.db["logger"]
+        logger = self.getConfig().logger
         if not logger:
             ctrls = self.getControls()
             if ctrls:
@@ -180,45 +360,64 @@ class datahandler(object):
 
         return retval
 
-    def getMonValue(self, ctrl, key = ""):
-        value = 0
-        loc = self.getLocation(ctrl, key)
-
-        if loc:
-            value = self.readDevFile(loc)
-            if key == "temp":
-                value = self.tempCalc(value/1000)
-        return value
+    def getPlan(self, ctrl):
+        self.hwmon()
+        if self.plangen != self.hwmon.generation:
+            self.closePlans()
+        if not ctrl in self.plans:
+            # watched alarms are not read with the sample
+            alarms = [] if self.alarms else self.getAlarms(ctrl)
+            self.plans[ctrl] = hwmonplan(self.pool, ctrl, self.getLocation(ctrl, "temp"),
+                                         self.getLocation(ctrl, "fan"), self.getLocation(ctrl), alarms)
+        return self.plans[ctrl]
+
+    def closePlans(self):
+        self.pool.close()
+        self.plans = {}
+        self.plangen = self.hwmon.generation
+        if self.alarms:
+            self.alarms.clear()
+
+    def getAlarms(self, ctrl):
+        # (location, text) of the alarms of the temp and fan input that are in the inventory
+        alarms = []
+        chips = self.hwmon()
+        for key, suffix, text in ALARM_ATTRS:
+            loc = self.getLocation(ctrl, key)
+            if loc:
+                folder, attr = os.path.split(loc)
+                attr = attr.rsplit("_", 1)[0] + suffix
+                hwmon = os.path.basename(folder)
+                if (not hwmon in chips) or (attr in chips[hwmon].alarms):
+                    alarms.append((os.path.join(folder, attr), text))
+        return alarms
+
+    def getSampleAlarms(self, ctrl, alarms = []):
+        if self.alarms and self.alarms.isWatching():
+            alarms = self.alarms.get(ctrl)
+        return alarms
+
+    def getSample(self, plan, values = None):
+        val = {}
+        temp, rpm, pwm, alarms = plan.sample(self.pool, values)
+        val['temp'] = self.tempCalc(temp/1000)
+        val['rpm'] = rpm
+        val['pwm'] = pwm
+        val['alarm'] = self.getAlarmText(self.getSampleAlarms(plan.ctrl, alarms))
+        return val
 
-    def getAlarms(self, ctrl, temp, fan):
+    def getAlarmText(self, alarms):
         alarm = "Ok"
-        loc = self.getLocation(ctrl, temp)
-        if loc:
-            part = loc.rsplit("_", 1)[0]
-            if self.getAlarm(part + "_alarm"):
-                self.setAlarmText(alarm, "Temperature alarm")
-            if self.getAlarm(part + "_crit_alarm"):
-                self.setAlarmText(alarm, "Temperature critical")
-
-        loc = self.getLocation(ctrl, fan)
-        if loc:
-            part = loc.rsplit("_", 1)[0]
-            if self.getAlarm(part + "_alarm"):
-                self.setAlarmText(alarm, "Fan alarm")
-
+        for text in alarms:
+            alarm = self.setAlarmText(alarm, text)
         return alarm
 
-    def getAlarm(self, loc):
-        value = self.readDevFile(loc)
-        if not value:
-            value = 0
-        return value
-
     def setAlarmText(self, alarm, text):
         if alarm == "Ok":
             alarm = text
         else:
             alarm = alarm + " & " + text
+        return alarm
 
     def getLocation(self, ctrl, key = ""):
         loc = ""
@@ -226,54 +425,24 @@ class datahandler(object):
         inp = ""
 
         try:
+            config = self.getConfig()
             if not ctrl:
                 hwmon = key
-            elif not key: #pwm location
-                hwmon = ctrl.split("/", 1)[0]
-                inp = ctrl.split("/", 1)[1]
             else:
-                hwmon = self.db["fans"][ctrl][key].split("/", 1)[0]
-                inp = self.db["fans"][ctrl][key].split("/", 1)[1]
+                hwmon, inp = config.fans[ctrl].location(key)
 
             if os.path.exists(HWMON_FOLDER):
                 loc = os.path.join(HWMON_FOLDER, hwmon, inp)
             else:
                 #/sys/devices/platform/coretemp.0/hwmon/hwmon1/
-                loc = os.path.join(SYS_FOLDER, self.db["devices"][hwmon]["devpath"], hwmon, inp)
+                loc = os.path.join(SYS_FOLDER, config.devices[hwmon].devpath, hwmon, inp)
         except:
             pass
 
         return loc
 
     def getDevices(self):
-        devices = {}
-        # do not look in /sys/bus/i2c/devices -> obsolete for 2.x kernels
-        if os.path.exists(HWMON_FOLDER):
-            devdirs = os.listdir(HWMON_FOLDER)
-            for devdir in devdirs:
-                if devdir.startswith(HWMON_SUB):
-                    device = {}
-                    devpath = ""
-                    try:
-                        lndir = os.readlink(os.path.join(HWMON_FOLDER, devdir, "device"))
-                        devpath = os.path.realpath(os.path.join(HWMON_FOLDER, devdir, lndir)).replace("/sys/", "")
-                    except:
-                        pass
-                    device["devpath"] = devpath
-                    device["devname"] = self.readDevFile(os.path.join(HWMON_FOLDER, devdir, "name"))
-                    devices[devdir] = device
-        else: #do not search in all devices
-            pass
-        return devices
-
-    def readDevFile(self, loc):
-        val = ""
-        try:
-            with open(loc) as f:
-                val = self.gettype(f.read().strip("\n"))
-        except:
-            pass
-        return val
+        return self.hwmon.getDevices()
 
     def tempCalc(self, temp, inv = False):
         rtemp = temp
@@ -364,35 +533,69 @@ class datahandler(object):
         return nnr
 
     def findControls(self):
-        fans = []
         ctrls = {}
-        if "fans" in self.db:
-            fans = list(self.db["fans"].keys())
-        for fan in fans:
+        config = self.getConfig()
+        devices = self.getDevices()
+        for fan in config.fans.values():
             ctrl = {}
-            hwmon = fan.split("/")[0]
-            devices = self.getDevices()
             ctrl["device"] = ""
-            if hwmon in devices.keys():
-                ctrl["device"] = devices[hwmon]["devname"]
-            ctrl["name"] = ""
-            if "name" in self.db["fans"][fan] and self.db["fans"][fan]["name"]:
-                ctrl["name"] = self.db["fans"][fan]["name"]
+            if fan.hwmon in devices:
+                ctrl["device"] = devices[fan.hwmon]["devname"]
+            if fan.name:
+                ctrl["name"] = fan.name
             else:
-                ctrl["name"] = ctrl["device"] + ":" + fan
-            ctrl["default"] = False
-            if "logger" in self.db:
-                if self.db["logger"] == fan:
-                    ctrl["default"] = True
-            ctrls[fan] = ctrl
+                ctrl["name"] = ctrl["device"] + ":" + fan.ctrl
+            ctrl["default"] = (config.logger == fan.ctrl)
+            ctrls[fan.ctrl] = ctrl
         return ctrls
 
     def getDataFile(self):
-        self.db = self.getXML()
-        self.db.update(self.getCtrlFile())
-        self.addNames(self.db)
+        # stamp before parsing, a file written meanwhile is parsed again next time
+        stamp = self.getStamp()
+        db = self.loadConf(stamp)
+        if db != None:
+            self.db = db
+        else:
+            self.db = self.getXML()
+            self.addDefaults(self.db)
+            self.db.update(self.getCtrlFile())
+            self.addNames(self.db)
+            self.saveConf(stamp, self.db)
+
+    def loadConf(self, stamp):
+        db = None
+        try:
+            with open(CONF_FILENAME) as f:
+                conf = json.load(f)
+            if conf["version"] == CONF_VERSION and conf["stamp"] == stamp:
+                db = conf["db"]
+        except:
+            db = None
+        return db
+
+    def saveConf(self, stamp, db):
+        tmpname = "{}.{}".format(CONF_FILENAME, os.getpid())
+        try:
+            if not os.path.isdir(CACHE_FOLDER):
+                os.makedirs(CACHE_FOLDER, 0o755)
+            with open(tmpname, "w") as f:
+                json.dump({"version": CONF_VERSION, "stamp": stamp, "db": db}, f)
+            os.replace(tmpname, CONF_FILENAME)
+        except:
+            try:
+                os.unlink(tmpname)
+            except:
+                pass
+
+    def dropConf(self):
+        # a rewrite may keep inode, size and (coarse) mtime of a file
+        try:
+            os.unlink(CONF_FILENAME)
+        except:
+            pass
 
     def getXML(self):
+        import xml.etree.ElementTree as ET
         db = {}
         XMLpath = self.getCpitPath()
         try:
@@ -411,12 +614,7 @@ class datahandler(object):
         db = {}
         try:
             with open(FilePath) as f:
-                while True:
-                    line = f.readline().strip()
-                    if not line:
-                        break
-                    self.parseLine(line, db)
-
+                db, self.comments = self.parseCtrl(f)
         except Exception as e:
             print("Error parsing fancontrol file")
             print("Check fancontrol file syntax for errors")
@@ -424,6 +622,12 @@ class datahandler(object):
             exit(1)
         return db
 
+    def addDefaults(self, db):
+        # settings added in later versions are missing in older xml files
+        for key, value in DEF_SETTINGS.items():
+            if not key in db:
+                db[key] = value
+
     def addNames(self, db):
         if "fans" in db:
             for fan in db["fans"].keys():
@@ -436,76 +640,67 @@ class datahandler(object):
         if "names" in db:
             del db["names"]
 
-    def parseLine(self, line, db):
-        val = self.getValue(line, "INTERVAL")
-        if val:
-            db["interval"] = int(val)
-        elif not "interval" in db:
-            db["interval"] = 0
-        if not "devices" in db:
-            db["devices"] = {}
-        val = self.getValue(line, "DEVPATH")
-        if val:
-            self.splitValues(val, db["devices"], "devpath")
-        val = self.getValue(line, "DEVNAME")
-        if val:
-            self.splitValues(val, db["devices"], "devname")
-        if not "fans" in db:
-            db["fans"] = {}
-        val = self.getValue(line, "FCTEMPS")
-        if val:
-            self.splitValues(val, db["fans"], "temp")
-        val = self.getValue(line, "FCFANS")
-        if val:
-            self.splitValues(val, db["fans"], "fan")
-        val = self.getValue(line, "MINTEMP")
-        if val:
-            self.splitValues(val, db["fans"], "mintemp", True)
-        val = self.getValue(line, "MAXTEMP")
-        if val:
-            self.splitValues(val, db["fans"], "maxtemp", True)
-        val = self.getValue(line, "MINSTART")
-        if val:
-            self.splitValues(val, db["fans"], "minstart")
-        val = self.getValue(line, "MINSTOP")
-        if val:
-            self.splitValues(val, db["fans"], "minstop")
-        val = self.getValue(line, "MINPWM")
-        if val:
-            self.splitValues(val, db["fans"], "minpwm")
-        val = self.getValue(line, "MAXPWM")
-        if val:
-            self.splitValues(val, db["fans"], "maxpwm")
-
-    def getValue(self, line, param):
-        val = ""
-        param += "="
-        if line.startswith(param):
-            val = line.replace(param, "")
-        return val
-
-    def splitValues(self, vals, dbx, param, temp = False):
-        for val in vals.strip().split():
-            kval = self.splitKeyVal(val)
-            if not kval[0] in dbx:
-                dbx[kval[0]] = {}
-            rv = self.gettype(kval[1])
-            if temp:
-                rv = self.tempCalc(rv)
-            dbx[kval[0]].update({ param: rv })
-
-    def splitKeyVal(self, val):
-        kval = val.split("=")
-        if len(kval) < 2:
-            kval.insert(0, "")
-        return kval
+    def parseCtrl(self, lines):
+        """
+        Parses the lines of the fancontrol file in a single pass, each line
+        is dispatched on its keyword by CTRL_KEYS. Returns the settings and
+        the comment lines. Unknown keywords are skipped, syntax errors raise
+        ValueError with the line number.
+        """
+        db = {"interval": 0, "devices": {}, "fans": {}}
+        comments = []
+        for nr, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] == "#":
+                comments.append(line)
+                continue
+            key, sep, vals = line.partition("=")
+            if not sep:
+                raise ValueError("Line {}: expected <KEYWORD>=<values>: {}".format(nr, line))
+            if not key in CTRL_KEYS:
+                continue
+            section, param, ctype = CTRL_KEYS[key]
+            if not section:
+                db[param] = self.ctrlValue(vals.strip(), ctype, nr, key)
+                continue
+            dbx = db[section]
+            for val in vals.split():
+                dev, sep, val = val.partition("=")
+                if not sep or not dev:
+                    raise ValueError("Line {}: {}: expected <device>=<value>: {}".format(nr, key, dev))
+                if not dev in dbx:
+                    dbx[dev] = {}
+                dbx[dev][param] = self.ctrlValue(val, ctype, nr, key)
+        return db, comments
+
+    def ctrlValue(self, val, ctype, nr, key):
+        if ctype == CTRL_TEXT:
+            return val
+        try:
+            rv = int(val)
+        except ValueError:
+            try:
+                rv = float(val)
+            except ValueError:
+                raise ValueError("Line {}: {}: invalid number: {}".format(nr, key, val))
+        if ctype == CTRL_TEMP:
+            rv = self.tempCalc(rv)
+        return rv
 
     def updateDataFile(self, nr):
+        changed = 0
         if (nr & 1):
             self.getNames(self.db)
-            self.updateXML()
+            if self.updateXML():
+                changed = changed | 1
         if (nr & 2):
-            self.updateCtrlFile()
+            if self.updateCtrlFile():
+                changed = changed | 2
+        if changed:
+            self.dropConf()
+        return changed
 
     def getNames(self, db):
         names = {}
@@ -538,8 +733,7 @@ class datahandler(object):
 
         FilePath = self.getPath(dowrite = True)
 
-        with open(FilePath, "w") as f:
-            f.writelines(line + '\n' for line in lines)
+        return self.writeFile(FilePath, "".join(line + '\n' for line in lines))
 
     def buildLine(self, db, lines, key, param):
         if key in db:
@@ -563,24 +757,10 @@ class datahandler(object):
             lines.append(line)
 
     def getComment(self):
-        comment = []
-        FilePath = self.getPath()
-        db = {}
-        try:
-            with open(FilePath) as f:
-                while True:
-                    line = f.readline().strip()
-                    if not line:
-                        break
-                    if line.startswith("#"):
-                        comment.append(line)
-
-        except Exception as e:
-            print("Error parsing fancontrol file")
-            print("Check fancontrol file syntax for errors")
-            print(e)
-            exit(1)
-        return comment
+        # comments are kept when the file is parsed, a cached config did not parse it
+        if self.comments == None:
+            self.getCtrlFile()
+        return list(self.comments)
 
     def parseKids(self, item):
         db = {}
@@ -602,16 +782,17 @@ class datahandler(object):
         return retval
 
     def updateXML(self):
+        import xml.etree.ElementTree as ET
         XMLpath = self.getCpitPath(dowrite = True)
         db = ET.Element('settings')
         comment = ET.Comment(self.getXMLcomment("settings"))
         db.append(comment)
         resdb = {key: self.db[key] for key in self.db.keys() if key in DEF_SETTINGS.keys()}
         self.buildXML(db, resdb)
-        with open(XMLpath, "w") as xml_file:
-            xml_file.write(self.prettify(db))
+        return self.writeFile(XMLpath, self.prettify(db))
 
     def buildXML(self, xmltree, item):
+        import xml.etree.ElementTree as ET
         if isinstance(item, dict):
             for key, value in item.items():
                 kid = ET.SubElement(xmltree, key)
@@ -620,6 +801,7 @@ class datahandler(object):
             xmltree.text = self.settype(item)
 
     def createXML(self):
+        import xml.etree.ElementTree as ET
         #print("Creating new XML file")
         XMLpath = CPIT_FILENAME
         self.checkEtcWritable()
@@ -629,8 +811,46 @@ class datahandler(object):
         db.append(comment)
         settings = DEF_SETTINGS
         self.buildXML(db, settings)
-        with open(XMLpath, "w") as xml_file:
-            xml_file.write(self.prettify(db))
+        self.writeFile(XMLpath, self.prettify(db))
+
+    def writeFile(self, path, content):
+        """
+        Writes content if it differs from the file, returns whether it did.
+        The file is replaced atomically (temporary file, fsync, rename), so
+        fancontrol never reads a half written file.
+        """
+        data = content.encode(ENCODING)
+        mode = 0o644
+        try:
+            with open(path, "rb") as f:
+                if f.read() == data:
+                    return False
+            mode = os.stat(path).st_mode & 0o7777
+        except OSError:
+            pass
+        tmpname = "{}.{}".format(path, os.getpid())
+        try:
+            with open(tmpname, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fchmod(f.fileno(), mode)
+                os.fsync(f.fileno())
+            os.replace(tmpname, path)
+        except:
+            try:
+                os.unlink(tmpname)
+            except:
+                pass
+            raise
+        try:
+            dirfd = os.open(os.path.dirname(path), os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+        except OSError:
+            pass
+        return True
 
     def getXMLcomment(self, tag):
         comment = ""
@@ -653,6 +873,8 @@ class datahandler(object):
     def prettify(self, elem):
         """Return a pretty-printed XML string for the Element.
         """
+        import xml.etree.ElementTree as ET
+        from xml.dom.minidom import parseString
         rough_string = ET.tostring(elem, ENCODING)
         reparsed = parseString(rough_string)
         return reparsed.toprettyxml(indent="\t").replace('<?xml version="1.0" ?>','<?xml version="1.0" encoding="%s"?>' % ENCODING)
@@ -12,7 +12,7 @@
 import sys
 import os
 import json
-import subprocess
+import time
 from datahandler import datahandler
 
 #########################################################
@@ -20,18 +20,29 @@ from datahandler import datahandler
 ####################### GLOBALS #########################
 VERSION      = "0.81"
 DAEMONSFC    = "fancontrol"
+LOGGERSFC    = "fancontrol-logger"
+LOGGERPY     = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fancontrol-logger.py")
+LOGGERKEYS   = ["farenheit"] # and all logger... keys, a running logger reloads on these
 CMDNOTEXIST  = 127
 CMDTIMEOUT   = 124
 SYSTEMCTL    = "systemctl"
-CTLSTART     = SYSTEMCTL + " start"
-CTLSTOP      = SYSTEMCTL + " stop"
-CTLRELOAD    = SYSTEMCTL + " reload"
-CTLRESTART   = SYSTEMCTL + " restart"
-CTLENABLE    = SYSTEMCTL + " enable"
-CTLDISABLE   = SYSTEMCTL + " disable"
-CTLSTATUS    = SYSTEMCTL + " status"
-CTLISACTIVE  = SYSTEMCTL + " is-active"
-CTLISENABLED = SYSTEMCTL + " is-enabled"
+CTLSTART     = [SYSTEMCTL, "start"]
+CTLSTOP      = [SYSTEMCTL, "stop"]
+CTLRELOAD    = [SYSTEMCTL, "reload"]
+CTLRESTART   = [SYSTEMCTL, "restart"]
+CTLENABLE    = [SYSTEMCTL, "enable"]
+CTLDISABLE   = [SYSTEMCTL, "disable"]
+CTLSTATUS    = [SYSTEMCTL, "status"]
+CTLISACTIVE  = [SYSTEMCTL, "is-active"]
+CTLISENABLED = [SYSTEMCTL, "is-enabled"]
+CTLSHOW      = [SYSTEMCTL, "show"]
+CTLSTATE     = ["LoadState", "ActiveState", "SubState", "UnitFileState", "MainPID", "NRestarts"]
+CTLNUMBERS   = ["MainPID", "NRestarts"]
+JOURNALCTL   = ["journalctl", "-o", "json", "--no-pager"]
+LOGLINES     = 100
+LOGDATE      = "%b %d %H:%M:%S"
+CLIFLAGS     = ["--batch", "--lines", "--cursor"]
+BATCHOPS     = ["set", "del"]
 #########################################################
 
 ###################### FUNCTIONS ########################
@@ -40,6 +51,8 @@ CTLISENABLED = SYSTEMCTL + " is-enabled"
 # Class : shell                                         #
 #########################################################
 class shell(object):
+    found = {} # command: path or None, PATH lookups of this process
+
     def __init__(self):
         pass
 
@@ -47,16 +60,20 @@ class shell(object):
         pass
 
     def runCommand(self, cmd, input = None, timeout = None):
+        # cmd as list is executed directly, as string by the shell
+        import subprocess
         CMDNOTEXIST = 127, "", ""
         if input:
             input = input.encode("utf-8")
         try:
             if timeout == 0:
-                timout = None
-            out = subprocess.run(cmd, shell=True, capture_output=True, input = input, timeout = timeout)
+                timeout = None
+            out = subprocess.run(cmd, shell=isinstance(cmd, str), capture_output=True, input = input, timeout = timeout)
             retval = out.returncode, out.stdout.decode("utf-8"), out.stderr.decode("utf-8")
         except subprocess.TimeoutExpired:
             retval = CMDTIMEOUT, "", ""
+        except OSError:
+            retval = CMDNOTEXIST
 
         return retval
 
@@ -71,9 +88,11 @@ class shell(object):
         return stdout
 
     def commandExists(self, cmd):
-        returncode, stdout, stderr = self.runCommand(cmd)
+        if not cmd in shell.found:
+            import shutil
+            shell.found[cmd] = shutil.which(cmd)
 
-        return returncode != CMDNOTEXIST
+        return shell.found[cmd] != None
 
     def handleError(self, returncode, stderr):
         exc = ("External command failed.\n"
@@ -103,7 +122,7 @@ class systemdctl(object):
     def start(self, service):
         retval = False
         if self.available():
-            cmd = "{} {}".format(CTLSTART, service)
+            cmd = CTLSTART + [service]
             try:
                 shell().command(cmd)
                 retval = True
@@ -114,7 +133,7 @@ class systemdctl(object):
     def stop(self, service):
         retval = False
         if self.available():
-            cmd = "{} {}".format(CTLSTOP, service)
+            cmd = CTLSTOP + [service]
             try:
                 shell().command(cmd)
                 retval = True
@@ -125,7 +144,7 @@ class systemdctl(object):
     def reload(self, service):
         retval = False
         if self.available():
-            cmd = "{} {}".format(CTLRELOAD, service)
+            cmd = CTLRELOAD + [service]
             try:
                 shell().command(cmd)
                 retval = True
@@ -136,7 +155,7 @@ class systemdctl(object):
     def restart(self, service):
         retval = False
         if self.available():
-            cmd = "{} {}".format(CTLRESTART, service)
+            cmd = CTLRESTART + [service]
             try:
                 shell().command(cmd)
                 retval = True
@@ -147,7 +166,7 @@ class systemdctl(object):
     def enable(self, service):
         retval = False
         if self.available():
-            cmd = "{} {}".format(CTLENABLE, service)
+            cmd = CTLENABLE + [service]
             try:
                 shell().command(cmd)
                 retval = True
@@ -158,7 +177,7 @@ class systemdctl(object):
     def disable(self, service):
         retval = False
         if self.available():
-            cmd = "{} {}".format(CTLDISABLE, service)
+            cmd = CTLDISABLE + [service]
             try:
                 shell().command(cmd)
                 retval = True
@@ -169,7 +188,7 @@ class systemdctl(object):
     def status(self, service):
         retval = []
         if self.available():
-            cmd = "{} {}".format(CTLSTATUS, service)
+            cmd = CTLSTATUS + [service]
             try:
                 retcode, stdout, stderr = shell().runCommand(cmd)
                 retval = stdout.splitlines()
@@ -180,7 +199,7 @@ class systemdctl(object):
     def isActive(self, service):
         retval = False
         if self.available():
-            cmd = "{} {}".format(CTLISACTIVE, service)
+            cmd = CTLISACTIVE + [service]
             try:
                 shell().command(cmd)
                 retval = True
@@ -188,10 +207,37 @@ class systemdctl(object):
                 pass
         return retval
 
+    def state(self, services):
+        """
+        State of the services from a single systemctl show:
+        {service: {property: value}} for the properties in CTLSTATE.
+        """
+        retval = {}
+        if self.available():
+            cmd = CTLSHOW + ["--property=" + ",".join(CTLSTATE)] + services
+            try:
+                stdout = shell().command(cmd)
+                # a block of properties per service, in order
+                blocks = stdout.strip("\n").split("\n\n")
+                for service, block in zip(services, blocks):
+                    state = {}
+                    for line in block.splitlines():
+                        key, sep, val = line.partition("=")
+                        if key in CTLNUMBERS:
+                            try:
+                                val = int(val)
+                            except ValueError:
+                                pass
+                        state[key] = val
+                    retval[service] = state
+            except:
+                retval = {}
+        return retval
+
     def isEnabled(self, service):
         retval = False
         if self.available():
-            cmd = "{} {}".format(CTLISENABLED, service)
+            cmd = CTLISENABLED + [service]
             try:
                 shell().command(cmd)
                 retval = True
@@ -235,7 +281,7 @@ class fccli(object):
                     print(self)
                     print("Version: {}".format(VERSION))
                     exit()
-                else:
+                elif not arg in CLIFLAGS:
                     self.parseError(arg)
         if len(argv) < 2:
             self.lst()
@@ -244,7 +290,9 @@ class fccli(object):
             if len(argv) < 3:
                 opt += " <name:optional> <json options>"
                 self.parseError(opt)
-            if len(argv) < 4:
+            if argv[2] == "--batch":
+                self.batch(sys.stdin.read())
+            elif len(argv) < 4:
                 self.set(argv[2])
             else:
                 self.set(argv[3], fan=argv[2])
@@ -273,6 +321,8 @@ class fccli(object):
             self.pwm()
         elif argv[1] == "all":
             self.all()
+        elif argv[1] == "snap":
+            self.snap()
         elif argv[1] == "mon":
             if len(argv) < 3:
                 self.mon()
@@ -285,7 +335,28 @@ class fccli(object):
                 self.parseError(opt)
             self.delfan(argv[2])
         elif argv[1] == "log":
-            self.log()
+            opt = argv[1] + " --lines <number> --cursor <cursor>"
+            lines = LOGLINES
+            cursor = None
+            args = argv[2:]
+            while args:
+                if len(args) < 2:
+                    self.parseError(opt)
+                if args[0] == "--lines":
+                    try:
+                        lines = int(args[1])
+                    except ValueError:
+                        self.parseError(opt)
+                    if lines < 1:
+                        self.parseError(opt)
+                elif args[0] == "--cursor":
+                    cursor = args[1]
+                else:
+                    self.parseError(opt)
+                args = args[2:]
+            self.log(lines, cursor)
+        elif argv[1] == "serve":
+            self.serve()
         elif not self.lst(argv[1]):
             self.parseError(argv[1])
 
@@ -295,18 +366,25 @@ class fccli(object):
         print("    {} {}".format(self.name, "<argument> <json options>"))
         print("    <arguments>")
         print("        set           : sets settings with <name:optional> <json options>")
+        print("        set --batch   : sets and deletes in one transaction, reads operations")
+        print("                        {\"op\": \"set\"|\"del\", \"fan\": <name>, \"options\": <json>}")
+        print("                        as JSON array or one per line from stdin")
         print("        get           : gets all settings <name:optional>")
         print("        gen           : gets generic settings")
         print("        del           : deletes fancontrol <name>")
         print("        ctl           : controls daemon (start, stop, enable, disable, restart,")
-        print("                                         reload, isactive, isenabled)")
+        print("                                         reload, isactive, isenabled, state)")
         print("        fns           : get available fan controls")
         print("        tmp           : get available temperature sensors")
         print("        rpm           : get available fan RPM inputs")
         print("        pwm           : get available fan PWM outputs")
         print("        all           : get all sensors and fans")
+        print("        snap          : lists current values of all fan controls")
         print("        mon           : get hwmon name and path <name>")
-        print("        log           : prints current fancontrol log")
+        print("        log           : prints the last fancontrol log entries and the cursor of the last")
+        print("                        entry, <--lines number:optional> (default {})".format(LOGLINES))
+        print("                        <--cursor cursor:optional> only prints entries after cursor")
+        print("        serve         : runs rpc server to keep data warm for the other arguments")
         print("        <no arguments>: lists current values")
         print("")
         print("JSON options may be entered as single JSON string using full name, e.g.")
@@ -324,8 +402,7 @@ class fccli(object):
 
     def lst(self, ctrl = None):
         # current values temp, fan RPM, fan PWM, alarm
-        db = datahandler()
-        vals = db.monitor(ctrl)
+        vals = self.query("monitor", ctrl)
         if vals:
             print(json.dumps(vals))
         return vals
@@ -347,89 +424,188 @@ class fccli(object):
                 dopts = opts
             nr = db.getUpdate(dopts)
             if nr > -1:
-                db.update(nr)
-                if nr&2:
+                changed = db.update(nr)
+                if (changed&1) and (not fan) and self.touchesLogger(opts):
+                    self.reloadLogger()
+                if changed&2:
                     self.ctl("restart")
             else:
                 self.parseError("Invalid settings format")
         except:
             self.parseError("Invalid settings format")
 
-    def get(self, fan = None, gen = False):
-        data = {}
+    def batch(self, text):
+        """
+        Applies all operations to the settings in memory, then writes the
+        files once and restarts fancontrol at most once. Nothing is written
+        if any operation fails. Prints the result of every operation.
+        """
         db = datahandler()
+        results = []
+        total = 0
+        logger = False
+        for index, op in enumerate(self.getBatch(text)):
+            result = {"index": index}
+            try:
+                if not isinstance(op, dict):
+                    raise ValueError(op if isinstance(op, str) else "Invalid operation")
+                kind = op.get("op", "set")
+                fan = op.get("fan")
+                result["op"] = kind
+                if fan:
+                    result["fan"] = fan
+                if not kind in BATCHOPS:
+                    raise ValueError("Invalid operation: {}".format(kind))
+                if kind == "del":
+                    nr = db.delCtrl(fan)
+                    if nr <= 0:
+                        raise ValueError("Invalid fan control")
+                else:
+                    opts = op.get("options", {})
+                    if not isinstance(opts, dict):
+                        raise ValueError("Invalid settings format")
+                    nr = db.getUpdate({"fans": {fan: opts}} if fan else opts)
+                    if nr < 0:
+                        raise ValueError("Invalid settings format")
+                    if not fan:
+                        logger = logger or self.touchesLogger(opts)
+                total = total | nr
+                result["result"] = True
+            except Exception as e:
+                result["result"] = False
+                result["error"] = str(e)
+            results.append(result)
+        data = {"results": results}
+        data["result"] = all(result["result"] for result in results)
+        if data["result"]:
+            changed = db.update(total)
+            data["changed"] = changed > 0
+            if (changed&1) and logger:
+                data["reload"] = self.reloadLogger()
+            if changed&2:
+                sctl = systemdctl()
+                data["restart"] = sctl.restart(DAEMONSFC)
+        print(json.dumps(data))
+        if not data["result"]:
+            exit(1)
+
+    def get(self, fan = None, gen = False):
         if (gen):
-            data = db()
-            if "fans" in data:
-                del data["fans"]
-        elif fan:
-            if "fans" in db():
-                for lfan in db()["fans"]:
-                    if lfan == fan:
-                        data = db()["fans"][lfan]
+            data = self.query("gen")
         else:
-            data = db()
-
+            data = self.query("get", fan)
         print(json.dumps(data))
 
     def fns(self):
-        print(json.dumps(datahandler().getControls()))
+        print(json.dumps(self.query("getControls")))
 
     def tmp(self):
-        print(json.dumps(datahandler().getTempSensors()))
+        print(json.dumps(self.query("getTempSensors")))
 
     def rpm(self):
-        print(json.dumps(datahandler().getFanInputs()))
+        print(json.dumps(self.query("getFanInputs")))
 
     def pwm(self):
-        print(json.dumps(datahandler().getPWMs()))
+        print(json.dumps(self.query("getPWMs")))
 
     def all(self):
-        data = {}
-        db = datahandler()
-        data["farenheit"] = db()['farenheit']
-        data["ctrls"] = db.getControls()
-        data["temps"] = db.getTempSensors()
-        data["rpms"] = db.getFanInputs()
-        data["pwms"] = db.getPWMs()
-        print(json.dumps(data))
+        print(json.dumps(self.query("all")))
+
+    def snap(self):
+        print(json.dumps(self.query("snapshot")))
 
     def mon(self, hwmon = None):
-        db = datahandler()
-        if hwmon == None:
-            fans = db.getControls()
-            if fans:
-                hwmon = fans[0].split("/")[0]
-        print(json.dumps(db.getHwMon(hwmon)))
+        print(json.dumps(self.query("getHwMon", hwmon)))
+
+    def serve(self):
+        from rpchandler import rpcserver
+        rpcserver().serve()
+
+    def query(self, method, *params):
+        # use the rpc server when it is running, otherwise handle locally
+        from rpchandler import rpcmethods, rpcclient
+        found, data = rpcclient().call(method, *params)
+        if not found:
+            data = rpcmethods()(method, list(params))
+        return data
 
     def delfan(self, ctrl = None):
         db = datahandler()
         try:
             nr = db.delCtrl(ctrl)
             if nr > 0:
-                db.update(nr)
-                if nr&2:
+                if db.update(nr)&2:
                     self.ctl("restart")
             else:
                 self.parseError("Invalid fan control")
         except:
             self.parseError("Invalid fan control")
 
-    def log(self):
+    def log(self, lines = LOGLINES, cursor = None):
         logdata = []
-        origdata = shell().command("journalctl -u fancontrol --no-pager -r").split("\n")
-        for origline in origdata:
+        cmd = JOURNALCTL + ["-u", DAEMONSFC, "-n", str(lines)]
+        if cursor:
+            cmd += ["--after-cursor", cursor]
+        try:
+            origdata = shell().command(cmd)
+        except Exception as e:
+            print(e)
+            exit(1)
+        for origline in origdata.splitlines():
+            try:
+                entry = json.loads(origline)
+            except ValueError:
+                continue
             logline = {}
-            log1 = origline.split("]:")
-            if len(log1) > 1:
-                log2 = log1[0].rsplit("[", 1)[0].rsplit(" ", 1)
-                log3 = log2[0].rsplit(" ", 1)
+            logline["date"] = self.getLogDate(entry.get("__REALTIME_TIMESTAMP"))
+            logline["app"] = self.getLogField(entry.get("SYSLOG_IDENTIFIER", entry.get("_COMM", "")))
+            logline["log"] = self.getLogField(entry.get("MESSAGE", ""))
+            logdata.append(logline)
+            cursor = entry.get("__CURSOR", cursor)
+        print(json.dumps({"log": logdata, "cursor": cursor}))
+
+    def getLogDate(self, usec):
+        try:
+            date = time.strftime(LOGDATE, time.localtime(int(usec) / 1000000))
+        except:
+            date = ""
+        return date
+
+    def getLogField(self, value):
+        # journal fields that are no valid utf-8 are a list of bytes
+        if isinstance(value, list):
+            try:
+                value = bytes(value).decode("utf-8", "replace")
+            except:
+                value = ""
+        return str(value)
 
-                logline["date"]=log3[0]
-                logline["app"]=log2[1]
-                logline["log"]=log1[1]
-                logdata.append(logline)
-        print(json.dumps(logdata))
+    def touchesLogger(self, opts):
+        return any((key in LOGGERKEYS) or key.startswith("logger") for key in opts)
+
+    def reloadLogger(self):
+        # a running logger only picks up its settings on SIGHUP
+        sctl = systemdctl()
+        if sctl.isActive(LOGGERSFC):
+            return sctl.reload(LOGGERSFC)
+        retcode, stdout, stderr = shell().runCommand([sys.executable, LOGGERPY, "reload"])
+        return retcode == 0
+
+    def getBatch(self, text):
+        # a JSON array (or single object) or NDJSON, lines that are no JSON become errors
+        try:
+            ops = json.loads(text)
+            return ops if isinstance(ops, list) else [ops]
+        except ValueError:
+            pass
+        ops = []
+        for nr, line in enumerate(text.splitlines(), 1):
+            if line.strip():
+                try:
+                    ops.append(json.loads(line))
+                except ValueError:
+                    ops.append("Invalid JSON format on line {}".format(nr))
+        return ops
 
     def ctl(self, opt):
         result = {}
@@ -455,6 +631,9 @@ class fccli(object):
             result['result'] = sctl.isActive(DAEMONSFC)
         elif opt == "isenabled":
             result['result'] = sctl.isEnabled(DAEMONSFC)
+        elif opt == "state":
+            result['state'] = sctl.state([DAEMONSFC, LOGGERSFC])
+            result['result'] = len(result['state']) > 0
         else:
             self.parseError("Invalid ctl option: {}".format(opt))
         print(json.dumps(result))
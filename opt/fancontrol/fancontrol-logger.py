@@ -12,17 +12,35 @@
 import sys
 import os
 import time
-import psutil
+import fcntl
+import socket
 import signal
+import select
+import math
 import json
+from datetime import datetime
 from datahandler import datahandler
+from loghandler import openlog, logstamp, bufferpath, logchannels, splitrow, joinrow, downsample, logretention, tierpath, LOG_FILENAME, LOG_FORMATS, LOG_TEXT, LOG_TIERS, ROW_AGGREGATE
+from loghandler import LOG_SYNCS, LOG_SYNC_NONE, LOG_FLUSHAGE
 
 #########################################################
 
 ####################### GLOBALS #########################
 VERSION      = "0.81"
 STDINTERVAL  = 60
-LOG_FILENAME = "/var/log/fancontrol-data.log"
+MININTERVAL  = 0.1
+SCHED_SKIP   = "skip"
+SCHED_CATCHUP= "catchup"
+SCHED_POLICIES = [SCHED_SKIP, SCHED_CATCHUP]
+SCHED_MAXCATCHUP = 10
+SCHED_RESYNC = 1.0
+LOG_ALL      = "all"
+LOGOPTS      = ["--tier", "--since", "--until", "--last", "--points", "--after", "--channel"]
+LOGFLAGS     = ["--ndjson"]
+FOLLOWPOLL   = 1
+DURATIONS    = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+PID_FILENAME = "/run/fancontrol/fancontrol-logger.pid"
+STOPPOLL     = 0.05
 
 #########################################################
 
@@ -50,6 +68,11 @@ class daemon(object):
         self.stdin = stdin
         self.stdout = stdout
         self.stderr = stderr
+        self.pidfile = PID_FILENAME
+        self.pidfd = -1
+        self.watchdog = 0        # systemd watchdog interval, 0 means no watchdog
+        self.wakeup = None       # longest time run() may block, to keep the watchdog alive
+        self.notified = 0
 
     def _sigterm_handler(self, signum, frame):
         self._canDaemonRun = False
@@ -61,6 +84,8 @@ class daemon(object):
         """
         Make a daemon, do double-fork magic.
         """
+        sys.stdout.flush()
+        sys.stderr.flush()
         try:
             pid = os.fork()
             if pid > 0:
@@ -93,15 +118,6 @@ class daemon(object):
         os.dup2(so.fileno(), sys.stdout.fileno())
         os.dup2(se.fileno(), sys.stderr.fileno())
 
-    def _getProces(self):
-        procs = []
-        for p in psutil.process_iter():
-            if self.processName in [part.split('/')[-1] for part in p.cmdline()]:
-                # Skip  the current process
-                if p.pid != os.getpid():
-                    procs.append(p)
-        return procs
-
     def start(self):
         """
         Start daemon.
@@ -111,27 +127,46 @@ class daemon(object):
         signal.signal(signal.SIGTERM, self._sigterm_handler)
         signal.signal(signal.SIGHUP, self._reload_handler)
         # Check if the daemon is already running.
-        procs = self._getProces()
-        if procs:
-            pids = ",".join([str(p.pid) for p in procs])
-            print("{} already running with PID {}".format(self.processName, pids))
+        if not self._lockPid():
+            print("{} already running with PID {}".format(self.processName, self._getPid()))
             sys.exit(1)
         else:
             print("{} started".format(self.processName))
-        # Daemonize the main process
+        # Daemonize the main process, the lock is inherited
         self._makeDaemon()
+        self._writePid()
         # Start a infinitive loop that periodically runs run() method
         self.init()
         self._infiniteLoop()
+        self.exit()
+
+    def foreground(self):
+        """
+        Run in the foreground, as a systemd service of Type=notify.
+        Readiness and watchdog keep-alives are sent to NOTIFY_SOCKET.
+        """
+        signal.signal(signal.SIGINT, self._sigterm_handler)
+        signal.signal(signal.SIGTERM, self._sigterm_handler)
+        signal.signal(signal.SIGHUP, self._reload_handler)
+        if not self._lockPid():
+            print("{} already running with PID {}".format(self.processName, self._getPid()))
+            sys.exit(1)
+        self.watchdog = self._getWatchdog()
+        if self.watchdog:
+            self.wakeup = self.watchdog / 2
+        self.init()
+        self._notify("READY=1\nMAINPID={}".format(os.getpid()))
+        self._infiniteLoop()
+        self._notify("STOPPING=1")
+        self.exit()
 
     def status(self):
         """
         Get status of the daemon.
         """
-        procs = self._getProces()
-        if procs:
-            pids = ",".join([str(p.pid) for p in procs])
-            print("{} is running with PID {}".format(self.processName, pids))
+        pid = self._getPid()
+        if pid:
+            print("{} is running with PID {}".format(self.processName, pid))
             exit(0)
         else:
             print("{} is not running".format(self.processName))
@@ -141,11 +176,10 @@ class daemon(object):
         """
         Reload the daemon.
         """
-        procs = self._getProces()
-        if procs:
-            for p in procs:
-                os.kill(p.pid, signal.SIGHUP)
-                print("{} send SIGHUP signal for PID {}".format(self.processName, p.pid))
+        pid = self._getPid()
+        if pid:
+            os.kill(pid, signal.SIGHUP)
+            print("{} send SIGHUP signal for PID {}".format(self.processName, pid))
         else:
             print("{} is not running".format(self.processName))
 
@@ -153,19 +187,23 @@ class daemon(object):
         """
         Stop the daemon.
         """
-        procs = self._getProces()
-        def on_terminate(process):
-            print("{} with PID {} terminated".format(self.processName, process.pid))
-            self.exit()
-        if procs:
-            for p in procs:
-                p.terminate()
-            gone, alive = psutil.wait_procs(procs, timeout=self.waitToHardKill, callback=on_terminate)
-            for p in alive:
-                print("{} with PID {} killed".format(self.processName, p.pid))
-                p.kill()
-        else:
+        pid = self._getPid()
+        if not pid:
             print("{} is not running".format(self.processName))
+            return
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            print("{} is not running".format(self.processName))
+            return
+        if self._waitPid(pid, self.waitToHardKill):
+            print("{} with PID {} terminated".format(self.processName, pid))
+        else:
+            print("{} with PID {} killed".format(self.processName, pid))
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
 
     def restart(self):
         """
@@ -186,10 +224,93 @@ class daemon(object):
             else:
                 while self._canDaemonRun:
                     self.run()
+                    self._keepAlive()
         except Exception as e:
             sys.stderr.write("Run method failed: {}".format(e))
             sys.exit(1)
 
+    def _lockPid(self):
+        """
+        Takes the lock on the pidfile, False if another instance holds it.
+        The kernel drops the lock when the process ends, so a pidfile that
+        is left behind is not taken for a running daemon.
+        """
+        folder = os.path.dirname(self.pidfile)
+        if not os.path.isdir(folder):
+            os.makedirs(folder, 0o755)
+        fd = os.open(self.pidfile, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self.pidfd = fd
+        self._writePid()
+        return True
+
+    def _writePid(self):
+        os.ftruncate(self.pidfd, 0)
+        os.pwrite(self.pidfd, "{}\n".format(os.getpid()).encode(), 0)
+
+    def _getPid(self):
+        """
+        PID of the running daemon or 0. Only a locked pidfile is read.
+        """
+        pid = 0
+        try:
+            fd = os.open(self.pidfile, os.O_RDONLY | os.O_CLOEXEC)
+        except OSError:
+            return pid
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except OSError:
+            try:
+                pid = int(os.pread(fd, 32, 0))
+            except ValueError:
+                pid = 0
+        finally:
+            os.close(fd)
+        return pid
+
+    def _waitPid(self, pid, timeout):
+        end = time.monotonic() + timeout
+        while self._getPid() == pid:
+            if time.monotonic() >= end:
+                return False
+            time.sleep(STOPPOLL)
+        return True
+
+    def _getWatchdog(self):
+        interval = 0
+        try:
+            if int(os.environ.get("WATCHDOG_PID", os.getpid())) == os.getpid():
+                interval = int(os.environ.get("WATCHDOG_USEC", 0)) / 1000000
+        except ValueError:
+            pass
+        return interval
+
+    def _notify(self, state):
+        """
+        sd_notify(), a datagram to the socket systemd passes in NOTIFY_SOCKET.
+        """
+        addr = os.environ.get("NOTIFY_SOCKET")
+        if not addr:
+            return False
+        if addr[0] == "@":
+            addr = "\0" + addr[1:]
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC) as sock:
+                sock.connect(addr)
+                sock.sendall(state.encode())
+        except OSError:
+            return False
+        self.notified = time.monotonic()
+        return True
+
+    def _keepAlive(self):
+        if self.watchdog and time.monotonic() - self.notified >= self.wakeup:
+            self._notify("WATCHDOG=1")
+
     def init(self):
         pass
 
@@ -200,6 +321,84 @@ class daemon(object):
     def run(self):
         pass
 
+#########################################################
+# Class : scheduler                                     #
+#########################################################
+
+class scheduler(object):
+    """
+    Deadline scheduler on time.monotonic(). Tick n is due at start + n *
+    interval, whatever the time the work takes, so samples do not drift.
+    Ticks that are missed (e.g. by a stalling driver) are run directly
+    (catchup, at most SCHED_MAXCATCHUP in a row) or skipped. A tick has
+    its wall clock time on the grid and the jitter of the sample in ms.
+    The wait is woken by signals through a wakeup fd.
+    """
+    def __init__(self, interval, policy = SCHED_SKIP):
+        self.interval = interval
+        self.policy = policy
+        self.missed = 0
+        # first tick on a multiple of the interval, or of a second
+        grid = min(interval, 1)
+        wall = time.time()
+        self.wall = math.ceil(wall / grid) * grid
+        self.start = time.monotonic() + (self.wall - wall)
+        self.tick = 0
+        self.rfd, self.wfd = os.pipe()
+        os.set_blocking(self.rfd, False)
+        os.set_blocking(self.wfd, False)
+        self.oldfd = signal.set_wakeup_fd(self.wfd)
+
+    def __del__(self):
+        pass
+
+    def close(self):
+        try:
+            signal.set_wakeup_fd(self.oldfd)
+        except:
+            pass
+        for fd in [self.rfd, self.wfd]:
+            try:
+                os.close(fd)
+            except:
+                pass
+
+    def wait(self, timeout = None):
+        """
+        Waits for the next tick, returns its time and jitter [ms], or
+        None when a signal arrived or timeout [s] passed first.
+        """
+        deadline = self.start + self.tick * self.interval
+        now = time.monotonic()
+        if now < deadline:
+            wait = deadline - now
+            if timeout != None and timeout < wait:
+                wait = timeout
+            ready, w, x = select.select([self.rfd], [], [], wait)
+            if ready:
+                try:
+                    os.read(self.rfd, 512)
+                except OSError:
+                    pass
+                return None
+            now = time.monotonic()
+            if now < deadline:
+                return None
+        late = int((now - deadline) // self.interval)
+        if late > 0 and (self.policy != SCHED_CATCHUP or late > SCHED_MAXCATCHUP):
+            self.tick += late
+            self.missed += late
+            deadline += late * self.interval
+        t = self.wall + self.tick * self.interval
+        # follow steps of the wall clock (ntp, suspend)
+        wall = time.time() - (now - deadline)
+        if abs(wall - t) > SCHED_RESYNC:
+            self.wall += wall - t
+            t = wall
+        self.tick += 1
+        t = round(float(t), 3)
+        return int(t) if t.is_integer() else t, round((now - deadline) * 1000, 3)
+
 #########################################################
 # Class : fclogger                                      #
 #########################################################
@@ -208,8 +407,15 @@ class daemon(object):
 class fclogger(daemon):
     def __init__(self, processName = ""):
         self.interval = STDINTERVAL
+        self.policy = SCHED_SKIP
+        self.schedule = None
         self.farenheit = False
-        self.ctrl = None
+        self.select = None
+        self.channels = []
+        self.fmt = LOG_TEXT
+        self.sync = LOG_SYNC_NONE
+        self.flushage = LOG_FLUSHAGE
+        self.retention = None
         self.db = None
         super(fclogger, self).__init__()
 
@@ -217,61 +423,116 @@ class fclogger(daemon):
         pass
 
     def settings(self, ctrl = None):
+        if ctrl:
+            self.select = ctrl # from the command line, kept on reload
         if not self.db:
             self.db = datahandler()
         if "loggerinterval" in self.db():
             try:
-                interval = int(self.db()["loggerinterval"])
+                interval = float(self.db()["loggerinterval"])
                 if interval <= 0:
                     interval = STDINTERVAL
-                self.interval = interval
+                interval = max(interval, MININTERVAL)
+                self.interval = int(interval) if interval.is_integer() else interval
             except:
                 pass
+        if "loggerpolicy" in self.db() and self.db()["loggerpolicy"] in SCHED_POLICIES:
+            self.policy = self.db()["loggerpolicy"]
         if "farenheit" in self.db():
             self.farenheit = self.db()["farenheit"]
+        if "loggerformat" in self.db() and self.db()["loggerformat"] in LOG_FORMATS:
+            self.fmt = self.db()["loggerformat"]
+        if "loggersync" in self.db() and self.db()["loggersync"] in LOG_SYNCS:
+            self.sync = self.db()["loggersync"]
+        if "loggerflush" in self.db():
+            try:
+                self.flushage = max(float(self.db()["loggerflush"]), 0)
+            except:
+                pass
+        if not ctrl and "loggerchannels" in self.db():
+            ctrl = self.db()["loggerchannels"]
         if not ctrl and "logger" in self.db():
             ctrl = self.db()["logger"]
-        self.ctrl = ctrl
+        self.channels = self.getChannels(ctrl)
+
+    def getChannels(self, ctrl):
+        # all fan controls, a comma separated list, one or the first
+        fans = list(self.db().get("fans", {}).keys())
+        if ctrl == LOG_ALL:
+            channels = fans
+        elif ctrl:
+            channels = [fan.strip() for fan in str(ctrl).split(",") if fan.strip()]
+        else:
+            channels = fans[:1]
+        if not channels:
+            channels = [""]
+        return channels
 
-    def init(self):
+    def init(self, buckets = None):
         try:
-            with open(LOG_FILENAME, 'w') as log_file:
-                isettings = [] #ctrl, farenheit, interval
-                if self.ctrl:
-                    isettings.append(self.ctrl)
-                else:
-                    isettings.append("")
-                if self.farenheit:
-                    isettings.append("F")
-                else:
-                    isettings.append("C")
-                isettings.append(str(self.interval))
-                log_file.write("{}".format(", ".join(isettings) + "\n"))
+            isettings = {}
+            isettings["fancontrol"] = self.channels[0]
+            isettings["channels"] = self.channels
+            isettings["farenheit"] = self.farenheit
+            isettings["interval"] = self.interval
+            isettings["jitter"] = True
+            self.schedule = scheduler(self.interval, self.policy)
+            self.retention = logretention(LOG_FILENAME, self.fmt, self.sync, self.flushage)
+            self.retention.open(isettings, time.time(), buckets)
             if not self.db:
                 self.db = datahandler()
         except:
             pass
 
+    def exit(self, persist = True):
+        # returns the unfinished buckets of the tiers
+        buckets = None
+        if self.retention:
+            try:
+                buckets = self.retention.close(persist)
+            except:
+                pass
+            self.retention = None
+        if self.schedule:
+            self.schedule.close()
+            self.schedule = None
+        return buckets
+
+    def reinit(self):
+        """
+        Reloads the settings (on SIGHUP) and continues logging with them.
+        Buffered rows are written with the old settings, changed settings
+        start a new segment in the logs. Unfinished tier buckets are handed
+        over and continued, or written with the old settings if changed.
+        """
+        self._notify("RELOADING=1\nMONOTONIC_USEC={}".format(int(time.monotonic() * 1000000)))
+        buckets = self.exit(False)
+        try:
+            self.db.reload()
+        except:
+            pass
+        self.settings(self.select)
+        self.init(buckets)
+        self._notify("READY=1")
+
     def run(self):
-        content = "0, 0, 0, Nok\n" # temp, rpm, pwm, alarm
+        if self.isReloadSignal:
+            self.isReloadSignal = False
+            self.reinit()
+        tick = self.schedule.wait(self.wakeup)
+        if not tick:
+            return
+        current_time, jitter = tick
+        samples = [None] * len(self.channels) # temp, rpm, pwm, alarm per channel
         try:
-            val = self.db.monitor(self.ctrl)
-            ival = []
-            ival.append(str(val['temp']))
-            ival.append(str(val['rpm']))
-            ival.append(str(val['pwm']))
-            ival.append(val['alarm'])
-            content = ", ".join(ival) + "\n"
+            fans = self.db.snapshot(self.channels)["fans"]
+            samples = [fans.get(ctrl) for ctrl in self.channels]
         except:
             pass
-        current_time = int(time.time())
         try:
-            if content:
-                with open(LOG_FILENAME, 'a') as log_file:
-                    log_file.write("{}, {}".format(current_time, content))
+            self.retention.append(current_time, samples, jitter)
         except:
             pass
-        time.sleep(self.interval)
 
 #########################################################
 # Class : fclgr                                         #
@@ -280,6 +541,7 @@ class fclogger(daemon):
 class fclgr(object):
     def __init__(self):
         self.name = ""
+        self.channels = []
 
     def __del__(self):
         pass
@@ -296,50 +558,114 @@ class fclgr(object):
         else:
             self.name = argv[0]
         logger = fclogger(self.name)
+        args, opts = self.getOpts(argv)
 
-        for arg in argv:
-            if arg[0] == "-":
-                if arg == "-h" or arg == "--help":
-                    self.printHelp()
-                    exit()
-                elif arg == "-v" or arg == "--version":
-                    print(self)
-                    print("Version: {}".format(VERSION))
-                    exit()
-                else:
-                    self.parseError(arg)
-        if len(sys.argv) >= 2:
-            choice = sys.argv[1]
+        if len(args) >= 1:
+            choice = args[0]
             if choice == "start":
-                ctrl = 0
-                if len(sys.argv) > 2:
-                    ctrl = int(sys.argv[2])
+                ctrl = None
+                if len(args) > 1:
+                    ctrl = args[1]
                 logger.settings(ctrl)
                 logger.start()
+            elif choice == "foreground":
+                ctrl = None
+                if len(args) > 1:
+                    ctrl = args[1]
+                logger.settings(ctrl)
+                logger.foreground()
             elif choice == "stop":
                 logger.stop()
+            elif choice == "reload":
+                logger.reload()
             elif choice == "status":
                 logger.status()
             elif choice == "list":
-                self.lst()
+                self.lst(opts)
+            elif choice == "tail":
+                self.tail(opts)
+            elif choice == "follow":
+                self.follow(opts)
             else:
-                self.parseError(argv[1])
+                self.parseError(choice)
                 sys.exit(1)
             sys.exit(0)
         else:
-            self.jlst()
+            self.jlst(opts)
             sys.exit(0)
 
+    def getOpts(self, argv):
+        args = []
+        opts = {}
+        i = 1
+        while i < len(argv):
+            arg = argv[i]
+            if arg == "-h" or arg == "--help":
+                self.printHelp()
+                exit()
+            elif arg == "-v" or arg == "--version":
+                print(self)
+                print("Version: {}".format(VERSION))
+                exit()
+            elif arg in LOGOPTS:
+                if i + 1 >= len(argv):
+                    self.parseError(arg)
+                opts[arg[2:]] = argv[i + 1]
+                i += 1
+            elif arg in LOGFLAGS:
+                opts[arg[2:]] = True
+            elif arg[0] == "-":
+                self.parseError(arg)
+            else:
+                args.append(arg)
+            i += 1
+        if "tier" in opts and not opts["tier"] in [name for name, step, keep in LOG_TIERS]:
+            self.parseError("Invalid tier: {}".format(opts["tier"]))
+        if "last" in opts:
+            if "since" in opts:
+                self.parseError("Use either --since or --last")
+            opts["since"] = time.time() - self.getDuration(opts["last"])
+        elif "since" in opts:
+            opts["since"] = self.getTime(opts["since"])
+        if "until" in opts:
+            opts["until"] = self.getTime(opts["until"])
+        if "after" in opts:
+            opts["after"] = self.getCursor(opts["after"])
+        if "channel" in opts:
+            opts["channel"] = [ctrl.strip() for ctrl in opts["channel"].split(",") if ctrl.strip()]
+        if "points" in opts:
+            try:
+                opts["points"] = int(opts["points"])
+            except ValueError:
+                opts["points"] = 0
+            if opts["points"] <= 0:
+                self.parseError("Invalid number of points")
+        return args, opts
+
     def printHelp(self):
         print(self)
         print("Usage:")
         print("    {} {}".format(self.name, "<argument>"))
         print("    <arguments>")
-        print("        start         : start logging <fan control to log = setting>")
+        print("        start         : start logging <fan control(s) to log = setting>")
+        print("                        (a fan control, a comma separated list or all)")
+        print("        foreground    : log in the foreground, as systemd service (Type=notify)")
         print("        stop          : stop logging")
+        print("        reload        : reload settings, changes start a new segment in the log")
         print("        status        : logger status (0=running, 1=not running)")
         print("        list          : prints logfile in CSV format")
+        print("        tail          : prints rows after --after in JSON format, with a new cursor")
+        print("        follow        : prints new rows as they are logged, in NDJSON format")
         print("        <no arguments>: prints logfile in JSON format")
+        print("    <options>")
+        print("        --tier <tier> : list retention tier raw (default), 1m or 1h")
+        print("        --since <time>: list from time (epoch seconds or ISO date/time)")
+        print("        --until <time>: list up to and including time")
+        print("        --last <dur>  : list the last duration, e.g. 90s, 30m, 6h, 2d or 1w")
+        print("        --points <n>  : downsample to about n rows with min/max values")
+        print("        --after <cur> : tail or follow after a cursor or a time")
+        print("        --channel <c> : list fan control(s) c (comma separated) of the log")
+        print("        --ndjson      : prints a JSON object per line, settings when changed")
         print("")
 
     def parseError(self, opt = ""):
@@ -350,65 +676,232 @@ class fclgr(object):
         print("Enter '{} -h' for help".format(self.name))
         exit(1)
 
-    def lst(self):
+    def lst(self, opts = {}):
+        settings = None
+        header = True
+        for kind, item in self.getItems(openlog(self.getPath(opts)), opts):
+            if kind == "settings":
+                if item == settings:
+                    continue
+                settings = item
+                print("Fan control: {}".format(" ".join(self.channels)))
+                print("Farenheit: {}".format(item["farenheit"]))
+                print("Interval: {}".format(item["interval"]))
+                header = True
+            else:
+                if header:
+                    # the columns follow from the first row of a segment
+                    print(", ".join(self.getColumns(item)))
+                    header = False
+                print(", ".join(str(val) for val in item))
+
+    def jlst(self, opts = {}):
+        log = openlog(self.getPath(opts))
+        self.dump(log, self.getItems(log, opts), opts)
+
+    def tail(self, opts = {}):
+        log = openlog(self.getPath(opts))
+        self.dump(log, self.select(log.tail(opts.get("after")), opts), opts, opts.get("after"))
+
+    def follow(self, opts = {}):
+        """
+        Polls the log and its buffer file for changes and prints the rows
+        appended since the last cursor, until terminated or the reader goes
+        away. Rows are printed when they are buffered, not when flushed.
+        """
+        def stop(signum, frame):
+            self.following = False
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        self.following = True
+        path = self.getPath(opts)
+        cursor = opts.get("after", time.time())
+        stamp = None
         try:
-            first = True
-            with open(LOG_FILENAME, 'r') as log_file:
-                while True:
-                    line = log_file.readline()
-                    if not line:
-                        break
-                    if first:
-                        first = False
-                        isettings = line.split(",")
-                        if len(isettings) == 3:
-                            print("Fan control: {}".format(isettings[0]))
-                            print("Farenheit: {}".format(isettings[1] == "F"))
-                            print("Interval: {}".format(isettings[2]))
-                        print("time, temp, rpm, pwm, alarm")
-                    else:
-                        print(line.strip())
-        except:
+            while self.following:
+                current = logstamp(path), logstamp(bufferpath(path))
+                if current != stamp:
+                    stamp = current
+                    log = openlog(path)
+                    for kind, item in self.select(log.tail(cursor), opts):
+                        self.writeItem(kind, item, opts)
+                    if log.cursor:
+                        cursor = log.cursor
+                        sys.stdout.write(json.dumps({"cursor": cursor}) + "\n")
+                    sys.stdout.flush()
+                time.sleep(FOLLOWPOLL)
+        except BrokenPipeError:
             pass
 
-    def jlst(self):
-        data = {}
+    def dump(self, log, items, opts, after = None):
+        """
+        Streams the rows as they are read, so memory does not grow with the
+        log. The settings (the last ones) and the cursor follow the data,
+        with the segments (time of their first row and settings) if the
+        data spans more than one. Rows after the first segment carry the
+        index of their segment, as downsampled rows of two segments may
+        share a time. The time of the oldest row in the log is added, so
+        readers can drop the rows that were trimmed since.
+        """
+        out = sys.stdout
         settings = {}
-        vals = []
+        if opts.get("ndjson"):
+            for kind, item in items:
+                self.writeItem(kind, item, opts)
+            out.write(json.dumps({"cursor": log.cursor if log.cursor else after}) + "\n")
+            return
+        sep = ""
+        segments = []
+        out.write('{"data": [')
+        for kind, item in items:
+            if kind == "settings":
+                settings = item
+            else:
+                if not segments or segments[-1]["settings"] != settings:
+                    segments.append({"time": item[0], "settings": settings})
+                row = self.getRow(item)
+                if len(segments) > 1:
+                    row['segment'] = len(segments) - 1
+                out.write(sep + json.dumps(row))
+                sep = ", "
+        settings = dict(settings)
+        settings["tier"] = self.getTier(opts)
+        out.write('], "settings": ' + json.dumps(settings))
+        if len(segments) > 1:
+            # the rows are in the units of their segment
+            out.write(', "segments": ' + json.dumps(segments))
+        # oldest() reads the log again, which resets the cursor
+        cursor = log.cursor if log.cursor else after
+        out.write(', "oldest": ' + json.dumps(log.oldest()))
+        out.write(', "cursor": ' + json.dumps(cursor) + '}\n')
+
+    def writeItem(self, kind, item, opts):
+        if kind == "settings":
+            settings = dict(item)
+            settings["tier"] = self.getTier(opts)
+            sys.stdout.write(json.dumps({"settings": settings}) + "\n")
+        else:
+            sys.stdout.write(json.dumps(self.getRow(item)) + "\n")
+
+    def getRow(self, item):
+        # a single channel as before, more channels by fan control
+        t, channels, jitter = splitrow(item, len(self.channels))
+        val = {}
+        val['time'] = t
+        if len(channels) == 1:
+            val.update(self.getValues(channels[0]))
+        else:
+            val['channels'] = {ctrl: self.getValues(values) for ctrl, values in zip(self.channels, channels)}
+        if jitter != None:
+            val['jitter'] = jitter
+        return val
+
+    def getValues(self, values):
+        val = {}
+        val['temp'] = values[0]
+        val['rpm'] = values[1]
+        val['pwm'] = values[2]
+        val['alarm'] = values[3]
+        if len(values) >= ROW_AGGREGATE:
+            val['tempmin'], val['tempmax'], val['rpmmin'], val['rpmmax'], val['pwmmin'], val['pwmmax'] = values[4:10]
+        return val
+
+    def getColumns(self, item):
+        t, channels, jitter = splitrow(item, len(self.channels))
+        columns = ["time"]
+        for ctrl, values in zip(self.channels, channels):
+            names = list(self.getValues(values).keys())
+            if len(channels) > 1:
+                names = ["{}:{}".format(ctrl, name) for name in names]
+            columns.extend(names)
+        if jitter != None:
+            columns.append("jitter")
+        return columns
+
+    def select(self, items, opts):
+        """
+        Keeps the --channel columns of the rows and the channels of the
+        current segment in self.channels. Channels that are not in a
+        segment are ignored, if none is left the first channel is listed.
+        """
+        wanted = opts.get("channel")
+        index = None
+        n = 1
+        for kind, item in items:
+            if kind == "settings":
+                channels = logchannels(item)
+                n = len(channels)
+                index = None
+                if wanted:
+                    index = [i for i, ctrl in enumerate(channels) if ctrl in wanted] or [0]
+                    channels = [channels[i] for i in index]
+                self.channels = channels
+                item = dict(item)
+                item["fancontrol"] = channels[0]
+                if len(channels) > 1:
+                    item["channels"] = channels
+                else:
+                    item.pop("channels", None)
+            elif index != None:
+                t, values, jitter = splitrow(item, n)
+                item = joinrow(t, [values[i] for i in index], jitter)
+            yield kind, item
+
+    def getTier(self, opts):
+        return opts.get("tier", LOG_TIERS[0][0])
+
+    def getPath(self, opts):
+        return tierpath(self.getTier(opts), LOG_FILENAME)
+
+    def getItems(self, log, opts):
+        since = opts.get("since")
+        until = opts.get("until")
+        items = self.select(log.read(since, until), opts)
+        if "points" in opts:
+            if since == None:
+                since = log.oldest()
+            if until == None:
+                until = time.time()
+            if since != None:
+                items = downsample(items, since, until, opts["points"])
+        return items
+
+    def getTime(self, text):
         try:
-            first = True
-            with open(LOG_FILENAME, 'r') as log_file:
-                while True:
-                    line = log_file.readline()
-                    if not line:
-                        break
-                    if first:
-                        first = False
-                        isettings = line.split(",")
-                        if len(isettings) == 3:
-                            settings["fancontrol"] = isettings[0]
-                            settings["farenheit"] = (isettings[1] == "F")
-                            try:
-                                settings["interval"] = int(isettings[2])
-                            except:
-                                settings["interval"] = 0
-                    else:
-                        val = {}
-                        content = line.split(",")
-                        try:
-                            val['time'] = content[0].strip()
-                            val['temp'] = content[1].strip()
-                            val['rpm'] = content[2].strip()
-                            val['pwm'] = content[3].strip()
-                            val['alarm'] = content[4].strip()
-                            vals.append(val)
-                        except:
-                            pass
-        except:
+            return float(text)
+        except ValueError:
+            pass
+        try:
+            return datetime.fromisoformat(text).timestamp()
+        except ValueError:
+            self.parseError("Invalid time: {}".format(text))
+
+    def getCursor(self, text):
+        # a time or a cursor 'inode:offset:time' of an earlier read
+        try:
+            return float(text)
+        except ValueError:
+            pass
+        try:
+            return datetime.fromisoformat(text).timestamp()
+        except ValueError:
             pass
-        data["settings"] = settings
-        data["data"] = vals
-        print(json.dumps(data))
+        try:
+            ino, off, t = text.split(":")
+            int(ino), int(off), float(t)
+        except ValueError:
+            self.parseError("Invalid cursor: {}".format(text))
+        return text
+
+    def getDuration(self, text):
+        unit = 1
+        if text and text[-1] in DURATIONS:
+            unit = DURATIONS[text[-1]]
+            text = text[:-1]
+        try:
+            return float(text) * unit
+        except ValueError:
+            self.parseError("Invalid duration: {}".format(text))
 
 ######################### MAIN ##########################
 if __name__ == "__main__":
@@ -0,0 +1,419 @@
+#!/usr/bin/python3
+
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : hwmonhandler.py                             #
+#           hwmon topology and sensor inventory for     #
+#           fancontrol, kept in memory and under /run.  #
+#           I. Helwegen 2023                            #
+#########################################################
+
+####################### IMPORTS #########################
+import os
+import json
+import time
+import select
+#########################################################
+
+####################### GLOBALS #########################
+HWMON_FOLDER  = "/sys/class/hwmon"
+SYS_FOLDER    = "/sys"
+HWMON_SUB     = "hwmon"
+CACHE_FOLDER  = "/run/fancontrol"
+TOPO_FILENAME = "/run/fancontrol/hwmon.json"
+TOPO_VERSION  = 2
+TOPO_CHECK    = 1.0
+PLAN_READSIZE = 32
+ALARM_REREAD  = 5.0
+#########################################################
+
+###################### FUNCTIONS ########################
+
+#########################################################
+# Class : hwmonchip                                     #
+#########################################################
+class hwmonchip(object):
+    """
+    Inventory of a single hwmon chip. temps maps each temperature input
+    to its label, fans, pwms and alarms list the attribute names.
+    """
+    __slots__ = ("hwmon", "devpath", "devname", "temps", "fans", "pwms", "alarms")
+
+    def __init__(self, hwmon, devpath = "", devname = ""):
+        self.hwmon = hwmon
+        self.devpath = devpath
+        self.devname = devname
+        self.temps = {}
+        self.fans = []
+        self.pwms = []
+        self.alarms = []
+
+    def device(self):
+        return {"devpath": self.devpath, "devname": self.devname}
+
+    def todict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    @classmethod
+    def fromdict(cls, data):
+        chip = cls(data["hwmon"], data["devpath"], data["devname"])
+        chip.temps = data["temps"]
+        chip.fans = data["fans"]
+        chip.pwms = data["pwms"]
+        chip.alarms = data["alarms"]
+        return chip
+
+#########################################################
+# Class : hwmonpool                                     #
+#########################################################
+class hwmonpool(object):
+    """
+    Pool of open sysfs attributes, shared by all plans so an attribute
+    used by several fan controls is opened once and, in a batch, read
+    once. Attributes that cannot be opened get fd -1 and read as 0.
+    """
+    def __init__(self):
+        self.fds = {}
+
+    def __del__(self):
+        self.close()
+
+    def open(self, loc):
+        if not loc:
+            return -1
+        if not loc in self.fds:
+            try:
+                self.fds[loc] = os.open(loc, os.O_RDONLY)
+            except:
+                self.fds[loc] = -1
+        return self.fds[loc]
+
+    def read(self, fd):
+        value = 0
+        if fd >= 0:
+            try:
+                data = os.pread(fd, PLAN_READSIZE, 0)
+                try:
+                    value = int(data)
+                except ValueError:
+                    value = float(data)
+            except:
+                pass
+        return value
+
+    def readAll(self, fds):
+        return {fd: self.read(fd) for fd in fds}
+
+    def close(self):
+        for fd in self.fds.values():
+            if fd >= 0:
+                try:
+                    os.close(fd)
+                except:
+                    pass
+        self.fds = {}
+
+#########################################################
+# Class : hwmonplan                                     #
+#########################################################
+class hwmonplan(object):
+    """
+    Resolved sysfs attributes of a single fan control. The temp, fan and
+    pwm attributes and the alarms (list of (location, text)) are opened
+    once from the pool and re-read with pread on every sample. Close the
+    pool when the topology or config changes.
+    """
+    __slots__ = ("ctrl", "temp", "fan", "pwm", "alarms")
+
+    def __init__(self, pool, ctrl, temp, fan, pwm, alarms = []):
+        self.ctrl = ctrl
+        self.temp = pool.open(temp)
+        self.fan = pool.open(fan)
+        self.pwm = pool.open(pwm)
+        self.alarms = []
+        for loc, text in alarms:
+            fd = pool.open(loc)
+            if fd >= 0:
+                self.alarms.append((fd, text))
+
+    def fds(self):
+        return [self.temp, self.fan, self.pwm] + [fd for fd, text in self.alarms]
+
+    def sample(self, pool, values = None):
+        """
+        Returns raw temp (millidegrees), rpm, pwm and the texts of the
+        alarms that are set. values ({fd: value}) holds attributes that
+        are already read for this sample.
+        """
+        if values == None:
+            values = pool.readAll(self.fds())
+        alarms = [text for fd, text in self.alarms if values[fd]]
+        return values[self.temp], values[self.fan], values[self.pwm], alarms
+
+#########################################################
+# Class : hwmonalarms                                   #
+#########################################################
+class hwmonalarms(object):
+    """
+    Alarm state of the fan controls, kept in memory. The alarm attributes
+    are opened once and waited on with epoll (EPOLLPRI), which drivers
+    that call sysfs_notify signal on a change, so only changed alarms are
+    read. For drivers that do not notify, all alarms are re-read every
+    ALARM_REREAD seconds. fileno() is readable when an alarm is signalled,
+    so it can be added to a selector.
+    """
+    def __init__(self, reread = ALARM_REREAD):
+        self.reread = reread
+        self.epoll = select.epoll()
+        self.pool = hwmonpool()
+        self.ctrls = None  # {ctrl: [(fd, text)]}, None when not watching
+        self.values = {}   # {fd: value}
+        self.checked = 0
+
+    def __del__(self):
+        self.close()
+
+    def fileno(self):
+        return self.epoll.fileno()
+
+    def isWatching(self):
+        return self.ctrls != None
+
+    def watch(self, alarms):
+        """
+        Watches the alarms {ctrl: [(location, text)]}, replaces the alarms
+        that were watched.
+        """
+        self.clear()
+        self.ctrls = {}
+        for ctrl, items in alarms.items():
+            self.ctrls[ctrl] = []
+            for loc, text in items:
+                fd = self.pool.open(loc)
+                if fd < 0:
+                    continue
+                if not fd in self.values:
+                    # reading arms the notification
+                    self.values[fd] = self.pool.read(fd)
+                    try:
+                        self.epoll.register(fd, select.EPOLLPRI)
+                    except OSError:
+                        pass
+                self.ctrls[ctrl].append((fd, text))
+        self.checked = time.monotonic()
+
+    def poll(self, timeout = 0):
+        """
+        Waits at most timeout [s] for alarms to be signalled, reads them
+        and returns the fan controls of which an alarm changed.
+        """
+        changed = []
+        if not self.isWatching():
+            return changed
+        try:
+            fds = set(fd for fd, event in self.epoll.poll(timeout))
+        except OSError:
+            fds = set()
+        now = time.monotonic()
+        if now - self.checked >= self.reread:
+            fds = set(self.values.keys())
+            self.checked = now
+        fds = set(fd for fd in fds if self.update(fd))
+        if fds:
+            changed = [ctrl for ctrl, items in self.ctrls.items() if any(fd in fds for fd, text in items)]
+        return changed
+
+    def get(self, ctrl):
+        # texts of the alarms that are set
+        alarms = []
+        if self.isWatching() and ctrl in self.ctrls:
+            alarms = [text for fd, text in self.ctrls[ctrl] if self.values[fd]]
+        return alarms
+
+    def clear(self):
+        for fd in self.values:
+            try:
+                self.epoll.unregister(fd)
+            except:
+                pass
+        self.pool.close()
+        self.ctrls = None
+        self.values = {}
+
+    def close(self):
+        self.clear()
+        try:
+            self.epoll.close()
+        except:
+            pass
+
+################## INTERNAL FUNCTIONS ###################
+
+    def update(self, fd):
+        value = self.pool.read(fd)
+        changed = value != self.values.get(fd)
+        self.values[fd] = value
+        return changed
+
+#########################################################
+# Class : hwmonindex                                    #
+#########################################################
+class hwmonindex(object):
+    """
+    Index of hwmon chips: {hwmonX: hwmonchip}.
+    The index is keyed by the name and inode of every entry in the hwmon
+    folder, which is a single directory read. A chip that is added, removed
+    or re-registered gets a new inode, so the key changes and only then
+    the device links, names, labels and attributes are read again, in a
+    single scandir pass per chip.
+    """
+    def __init__(self, persist = True):
+        self.persist = persist
+        self.key = None
+        self.chips = {}
+        self.devices = {}
+        self.checked = 0
+        self.generation = 0
+
+    def __del__(self):
+        pass
+
+    def __call__(self):
+        now = time.monotonic()
+        if (self.key == None) or (now - self.checked >= TOPO_CHECK):
+            key = self.getKey()
+            if key != self.key:
+                self.update(key)
+            self.checked = now
+        return self.chips
+
+    def getDevices(self):
+        self()
+        return self.devices
+
+    def invalidate(self):
+        self.key = None
+        self.chips = {}
+        self.devices = {}
+        self.checked = 0
+        self.generation += 1
+
+################## INTERNAL FUNCTIONS ###################
+
+    def getKey(self):
+        key = []
+        # do not look in /sys/bus/i2c/devices -> obsolete for 2.x kernels
+        try:
+            with os.scandir(HWMON_FOLDER) as it:
+                for entry in it:
+                    if entry.name.startswith(HWMON_SUB):
+                        key.append([entry.name, entry.inode()])
+        except:
+            pass
+        key.sort()
+        return key
+
+    def update(self, key):
+        chips = None
+        if self.persist:
+            chips = self.load(key)
+        if chips == None:
+            chips = self.scan(key)
+            if self.persist:
+                self.save(key, chips)
+        self.key = key
+        self.chips = chips
+        self.devices = {hwmon: chip.device() for hwmon, chip in chips.items()}
+        self.generation += 1
+
+    def scan(self, key):
+        chips = {}
+        for devdir, ino in key:
+            loc = os.path.join(HWMON_FOLDER, devdir)
+            devpath = ""
+            try:
+                lndir = os.readlink(os.path.join(loc, "device"))
+                devpath = os.path.realpath(os.path.join(loc, lndir)).replace("/sys/", "")
+            except:
+                pass
+            chip = hwmonchip(devdir, devpath, self.readName(os.path.join(loc, "name")))
+            self.scanChip(loc, chip)
+            chips[devdir] = chip
+        return chips
+
+    def scanChip(self, loc, chip):
+        labels = set()
+        temps = []
+        try:
+            with os.scandir(loc) as it:
+                for entry in it:
+                    attr = entry.name
+                    if attr.endswith("_alarm"):
+                        chip.alarms.append(attr)
+                    elif attr.endswith("_input"):
+                        if attr.startswith("temp"):
+                            temps.append(attr)
+                        elif attr.startswith("fan"):
+                            chip.fans.append(attr)
+                    elif attr.endswith("_label"):
+                        labels.add(attr)
+                    elif attr.startswith("pwm") and not "_" in attr:
+                        chip.pwms.append(attr)
+        except:
+            pass
+        for attr in sorted(temps, key = self.attrKey):
+            label = attr.replace("_input", "_label")
+            name = ""
+            if label in labels:
+                name = self.readName(os.path.join(loc, label))
+            chip.temps[attr] = name
+        chip.fans.sort(key = self.attrKey)
+        chip.pwms.sort(key = self.attrKey)
+        chip.alarms.sort(key = self.attrKey)
+
+    def attrKey(self, attr):
+        # temp2_input before temp10_input
+        base = attr.split("_", 1)[0]
+        prefix = base.rstrip("0123456789")
+        try:
+            nr = int(base[len(prefix):])
+        except:
+            nr = 0
+        return prefix, nr, attr
+
+    def readName(self, loc):
+        val = ""
+        try:
+            with open(loc) as f:
+                val = f.read().strip("\n")
+        except:
+            pass
+        return val
+
+    def load(self, key):
+        chips = None
+        try:
+            with open(TOPO_FILENAME) as f:
+                topo = json.load(f)
+            if topo["version"] == TOPO_VERSION and topo["key"] == key:
+                chips = {hwmon: hwmonchip.fromdict(chip) for hwmon, chip in topo["chips"].items()}
+        except:
+            chips = None
+        return chips
+
+    def save(self, key, chips):
+        tmpname = "{}.{}".format(TOPO_FILENAME, os.getpid())
+        try:
+            if not os.path.isdir(CACHE_FOLDER):
+                os.makedirs(CACHE_FOLDER, 0o755)
+            with open(tmpname, "w") as f:
+                json.dump({"version": TOPO_VERSION, "key": key,
+                           "chips": {hwmon: chip.todict() for hwmon, chip in chips.items()}}, f)
+            os.replace(tmpname, TOPO_FILENAME)
+        except:
+            try:
+                os.unlink(tmpname)
+            except:
+                pass
+
+#########################################################
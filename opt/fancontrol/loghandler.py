@@ -0,0 +1,1283 @@
+#!/usr/bin/python3
+
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : loghandler.py                               #
+#           data-log file formats and retention tiers   #
+#           for fancontrol-logger.                      #
+#           I. Helwegen 2023                            #
+#########################################################
+
+####################### IMPORTS #########################
+import os
+import json
+import math
+import time
+import collections
+import shutil
+import mmap
+import struct
+#########################################################
+
+####################### GLOBALS #########################
+LOG_FILENAME  = "/var/log/fancontrol-data.log"
+LOG_TEXT      = "text"
+LOG_BINARY    = "binary"
+LOG_FORMATS   = [LOG_TEXT, LOG_BINARY]
+BIN_MAGIC     = b"FCLB"
+BIN_VERSION   = 1
+BIN_HEADER    = struct.Struct("<4sHH")      # magic, version, reserved
+SEG_MAGIC     = b"FCSG"
+SEG_HEADER    = struct.Struct("<4sqII")     # magic, base time [ms], count, settings length
+SEG_OPEN      = 0xFFFFFFFF
+SEG_MAXDELTA  = 0xFFFFFFFE                  # [ms], ~49 days per segment
+REC_TIME      = "I"                         # delta to segment base [ms]
+REC_CHANNEL   = "iHBB"                      # temp [m°], rpm, pwm, alarm code
+REC_AGGREGATE = "iiHHBB"                    # temp, rpm, pwm min and max
+REC_JITTER    = "i"                         # sample jitter [us]
+ROW_CHANNEL   = 4                           # temp, rpm, pwm, alarm
+ROW_AGGREGATE = 10                          # and temp, rpm, pwm min and max
+LOG_TIERS     = [("raw", 0, 86400),         # name, step [s], retention [s]
+                 ("1m", 60, 2592000),
+                 ("1h", 3600, 31536000)]
+LOG_SLACK     = 0.1                         # trim when this fraction over retention
+LOG_TRIMCHUNK = 1048576                     # bytes copied per sample while trimming
+LOG_INDEXEXT  = ".idx"                      # sidecar index of text logs
+LOG_INDEXSTEP = 600                         # [s], minimum index bucket
+LOG_INDEXROWS = 64                          # rows per index bucket
+LOG_BUCKETEXT = ".bucket"                   # tier bucket that is not finished on close
+LOG_RUNFOLDER = "/run/fancontrol"           # unflushed rows for readers
+LOG_BUFFEREXT = ".buffer"
+LOG_BUFFERMAX = 4096                        # rows kept when flushing fails
+LOG_FLUSHCOUNT= 64                          # flush after this many rows
+LOG_FLUSHAGE  = 60                          # [s], or when the oldest row is this old
+LOG_SYNC_NONE = "none"                      # leave writeback to the kernel
+LOG_SYNC_FLUSH= "flush"                     # fsync after every flush
+LOG_SYNC_ALWAYS = "always"                  # flush and fsync every row
+LOG_SYNCS     = [LOG_SYNC_NONE, LOG_SYNC_FLUSH, LOG_SYNC_ALWAYS]
+ALARM_TEXTS   = ["Temperature alarm", "Temperature critical", "Fan alarm"]
+ALARM_OK      = "Ok"
+ALARM_NOK     = "Nok"
+ALARM_NOKCODE = 0x80
+ENCODING      = 'utf-8'
+#########################################################
+
+###################### FUNCTIONS ########################
+
+def logformat(path = None):
+    """
+    Detects the format of an existing log file from its magic.
+    """
+    fmt = LOG_TEXT
+    try:
+        with open(path if path else LOG_FILENAME, 'rb') as f:
+            if f.read(len(BIN_MAGIC)) == BIN_MAGIC:
+                fmt = LOG_BINARY
+    except:
+        pass
+    return fmt
+
+def openlog(path = None, fmt = None, sync = LOG_SYNC_NONE):
+    """
+    Returns a log object for path, of format fmt or of the detected format.
+    """
+    if not path:
+        path = LOG_FILENAME
+    if not fmt:
+        fmt = logformat(path)
+    if fmt == LOG_BINARY:
+        return binlog(path, sync)
+    return textlog(path, sync)
+
+def tierpath(tier, path = None):
+    """
+    Returns the file of a retention tier, e.g. fancontrol-data-1m.log.
+    """
+    if not path:
+        path = LOG_FILENAME
+    for name, step, keep in LOG_TIERS:
+        if name == tier and step:
+            root, ext = os.path.splitext(path)
+            return "{}-{}{}".format(root, name, ext)
+    return path
+
+def bufferpath(path = None):
+    """
+    Returns the file in LOG_RUNFOLDER with the rows of a log that are not
+    flushed yet.
+    """
+    return os.path.join(LOG_RUNFOLDER, os.path.basename(path if path else LOG_FILENAME) + LOG_BUFFEREXT)
+
+def logstamp(path = None):
+    """
+    Returns (inode, size) of a log file, which changes on every write.
+    """
+    try:
+        st = os.stat(path if path else LOG_FILENAME)
+        return st.st_ino, st.st_size
+    except OSError:
+        return None
+
+def logchannels(settings):
+    """
+    Returns the fan controls logged in a segment, older logs have one.
+    """
+    return settings.get("channels") or [settings.get("fancontrol") or ""]
+
+def samplerow(t, samples, jitter = None):
+    """
+    Converts datahandler.monitor() samples, one per channel, to a log row,
+    with the jitter of the sample [ms] as last value if given.
+    """
+    row = (t,)
+    for sample in samples:
+        if sample:
+            row += (sample['temp'], sample['rpm'], sample['pwm'], sample['alarm'])
+        else:
+            row += (0, 0, 0, ALARM_NOK)
+    if jitter != None:
+        row += (jitter,)
+    return row
+
+def splitrow(row, n):
+    """
+    Splits a row of n channels in (time, [channel values], jitter).
+    Channel values are (temp, rpm, pwm, alarm), aggregated rows add
+    (tempmin, tempmax, rpmmin, rpmmax, pwmmin, pwmmax).
+    """
+    width = ROW_AGGREGATE if len(row) >= 1 + ROW_AGGREGATE * n else ROW_CHANNEL
+    channels = [row[1 + width * i:1 + width * (i + 1)] for i in range(n)]
+    jitter = row[1 + width * n] if len(row) > 1 + width * n else None
+    return row[0], channels, jitter
+
+def joinrow(t, channels, jitter = None):
+    row = (t,)
+    for channel in channels:
+        row += tuple(channel)
+    if jitter != None:
+        row += (jitter,)
+    return row
+
+def alarmcode(alarm):
+    code = 0
+    if alarm != ALARM_OK:
+        for text in alarm.split(" & "):
+            if text in ALARM_TEXTS:
+                code |= 1 << ALARM_TEXTS.index(text)
+            else:
+                code |= ALARM_NOKCODE
+    return code
+
+def alarmtext(code):
+    if code & ALARM_NOKCODE:
+        return ALARM_NOK
+    texts = [text for bit, text in enumerate(ALARM_TEXTS) if code & (1 << bit)]
+    if not texts:
+        return ALARM_OK
+    return " & ".join(texts)
+
+def milli(value):
+    return int(round(value * 1000))
+
+def u16(value):
+    return min(max(int(value), 0), 0xFFFF)
+
+def u8(value):
+    return min(max(int(value), 0), 0xFF)
+
+def mstime(ms):
+    # seconds, as int when whole
+    if ms % 1000:
+        return ms / 1000
+    return ms // 1000
+
+def number(text):
+    text = text.strip()
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+def downsample(items, since, until, points):
+    """
+    Reduces the ("settings", dict) and ("data", row) items of the window
+    since .. until to about points aggregated rows, with min/max per
+    bucket so peaks remain visible. Settings get the bucket step as
+    interval and aggregate.
+    """
+    step = max(1, int(math.ceil((until - since) / max(points, 1))))
+    bucket = logbucket(step, int(since))
+    for kind, item in items:
+        if kind == "settings":
+            row = bucket.flush()
+            if row:
+                yield "data", row
+            bucket = logbucket(step, int(since), len(logchannels(item)))
+            settings = dict(item)
+            settings.pop("jitter", None)
+            settings["interval"] = step
+            settings["aggregate"] = step
+            yield kind, settings
+        else:
+            row = bucket.add(item)
+            if row:
+                yield "data", row
+    row = bucket.flush()
+    if row:
+        yield "data", row
+
+#########################################################
+# Class : logfile                                       #
+#########################################################
+class logfile(object):
+    """
+    Base class of the log formats. A log holds one or more segments, each
+    starting with its settings. Rows are (time, temp, rpm, pwm, alarm) for
+    every channel (fan control) in the settings, raw rows may add (jitter),
+    aggregated rows add (tempmin, tempmax, rpmmin, rpmmax, pwmmin, pwmmax)
+    per channel, see splitrow().
+    Formats implement create(), reopen(), segment(), write() and rows().
+    rows() keeps the inode of the file and the offset after the last item
+    it returned, a reader turns them into a cursor 'inode:offset:time' to
+    continue from later. create() and trimming replace the file, so the
+    cursor of an older file falls back to its time.
+    Writers keep the file open, call flush() to write the rows through
+    (and fsync them if sync is LOG_SYNC_FLUSH or LOG_SYNC_ALWAYS).
+    Trimming copies the rows that are kept in chunks, see startTrim(), the
+    formats implement trimStart(), trimValid() and trimDone().
+    """
+    def __init__(self, path, sync = LOG_SYNC_NONE):
+        self.path = path
+        self.sync = sync
+        self.settings = {}
+        self.handle = None
+        self.ino = None
+        self.offset = None
+        self.cursor = None
+        self.trimming = None
+
+    def __del__(self):
+        pass
+
+    def getHandle(self):
+        if not self.handle:
+            self.handle = open(self.path, 'ab')
+        return self.handle
+
+    def flush(self):
+        if self.handle:
+            self.handle.flush()
+            if self.sync != LOG_SYNC_NONE:
+                os.fsync(self.handle.fileno())
+
+    def close(self):
+        if self.handle:
+            try:
+                self.flush()
+            finally:
+                self.handle.close()
+                self.handle = None
+
+    def append(self, t, samples, jitter = None):
+        self.write(samplerow(t, samples, jitter))
+
+    def read(self, since = None, until = None, offset = None):
+        """
+        Generator of ("settings", dict) and ("data", row) for the rows
+        from since (or from offset) up to and including until. The format
+        seeks to since, only the settings in effect for rows in the window
+        are returned, or the last settings if no row is in the window.
+        self.cursor is the cursor after the last row returned.
+        """
+        pending = None
+        found = False
+        self.cursor = None
+        for kind, item in self.items(since, offset):
+            if kind == "settings":
+                pending = item
+            elif until != None and item[0] > until:
+                break
+            elif since == None or item[0] >= since:
+                if pending != None:
+                    yield "settings", pending
+                    pending = None
+                found = True
+                self.cursor = "{}:{}:{}".format(self.ino, self.offset, item[0])
+                yield kind, item
+        if not found and pending != None:
+            yield "settings", pending
+
+    def items(self, since = None, offset = None):
+        """
+        The items of the file, followed by the buffered rows that are not
+        flushed to it yet. The offset of the cursor remains in the file.
+        """
+        last = None
+        settings = None
+        for kind, item in self.rows(since, offset):
+            if kind == "settings":
+                settings = item
+            else:
+                last = item[0]
+            yield kind, item
+        for kind, item in self.buffered():
+            if kind == "settings":
+                if item != settings:
+                    yield kind, item
+            elif last == None or item[0] > last:
+                yield kind, item
+
+    def buffered(self):
+        """
+        Generator of the settings and rows in the buffer file of the log,
+        written by logretention for readers while they are not flushed.
+        """
+        try:
+            with open(bufferpath(self.path), 'r') as buf_file:
+                for line in buf_file:
+                    if not line.endswith("\n"):
+                        break
+                    item = json.loads(line)
+                    if isinstance(item, dict):
+                        if item.get("path") != self.path:
+                            break
+                        yield "settings", self.normalize(item["settings"])
+                    else:
+                        yield "data", tuple(item)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def normalize(self, settings):
+        # settings as they are read back from the log
+        return settings
+
+    def tail(self, after = None):
+        """
+        Generator of the items after a cursor of an earlier read, or
+        after a time. self.cursor is None if there are no new rows.
+        """
+        offset, since = self.parseCursor(after)
+        for kind, item in self.read(since if offset == None else None, None, offset):
+            if kind == "data" and since != None and item[0] <= since:
+                continue
+            yield kind, item
+
+    def parseCursor(self, after):
+        """
+        Returns (offset, time) for a cursor of the current file, or
+        (None, time) for a time or a cursor of a replaced file. Rows
+        up to time are already read, which includes buffered rows.
+        Raises ValueError on an invalid cursor.
+        """
+        offset = None
+        since = None
+        if after != None:
+            parts = str(after).split(":")
+            if len(parts) == 3:
+                ino, off, since = int(parts[0]), int(parts[1]), number(parts[2])
+                try:
+                    st = os.stat(self.path)
+                    if st.st_ino == ino and off <= st.st_size:
+                        offset = off
+                except OSError:
+                    pass
+            else:
+                since = number(parts[0])
+        return offset, since
+
+    def oldest(self):
+        for kind, item in self.read():
+            if kind == "data":
+                return item[0]
+        return None
+
+    def startTrim(self, cutoff):
+        """
+        Starts to drop the rows before cutoff. The settings in effect and
+        the bytes from the first row kept are copied to path + ".tmp" by
+        trimStep(), so the cost per call is bounded while the writer goes
+        on. Returns False if there is nothing to drop.
+        """
+        self.cancelTrim()
+        try:
+            start = self.trimStart(cutoff)
+        except (OSError, ValueError, struct.error):
+            start = None
+        if not start:
+            return False
+        head, pos, oldest, state = start
+        try:
+            tmp = open(self.path + ".tmp", 'wb')
+            tmp.write(head)
+        except OSError:
+            return False
+        self.trimming = [tmp, pos, oldest, state]
+        return True
+
+    def trimStep(self, chunk = LOG_TRIMCHUNK):
+        """
+        Copies at most chunk bytes. When the copy caught up with the log,
+        the rows written meanwhile are copied and the log is replaced.
+        Returns (True, time of the oldest row kept, or cutoff if none) when
+        done, (True, None) when cancelled, otherwise (False, None).
+        """
+        tmp, pos, oldest, state = self.trimming
+        try:
+            with open(self.path, 'rb') as log_file:
+                log_file.seek(pos)
+                data = log_file.read(chunk)
+            tmp.write(data)
+            self.trimming[1] = pos + len(data)
+            if len(data) >= chunk:
+                return False, None
+            if not self.trimValid(state):
+                self.cancelTrim()
+                return True, None
+            self.close()
+            with open(self.path, 'rb') as log_file:
+                log_file.seek(pos + len(data))
+                shutil.copyfileobj(log_file, tmp)
+            tmp.flush()
+            if self.sync != LOG_SYNC_NONE:
+                os.fsync(tmp.fileno())
+            tmp.close()
+            os.replace(tmp.name, self.path)
+        except OSError:
+            self.cancelTrim()
+            return True, None
+        self.trimming = None
+        self.trimDone(state)
+        return True, oldest
+
+    def cancelTrim(self):
+        if self.trimming:
+            tmp = self.trimming[0]
+            self.trimming = None
+            try:
+                tmp.close()
+                os.unlink(tmp.name)
+            except OSError:
+                pass
+
+    def trimValid(self, state):
+        # the bytes before the copied position did not change
+        return True
+
+#########################################################
+# Class : textlog                                       #
+#########################################################
+class textlog(logfile):
+    """
+    Text log: settings lines 'ctrl [ctrl ...], C|F, interval' followed by
+    lines of 'time, temp, rpm, pwm, alarm' with the values repeated for
+    every ctrl (and the jitter, or the min/max values if aggregated).
+    A sidecar index (log + LOG_INDEXEXT) holds lines of 'time, settings
+    offset, row offset' for the first row of every index bucket, so a
+    reader can seek close to since instead of parsing the whole log.
+    """
+    def __init__(self, path, sync = LOG_SYNC_NONE):
+        super(textlog, self).__init__(path, sync)
+        self.fmt = LOG_TEXT
+        self.idxpath = path + LOG_INDEXEXT
+        self.setoff = 0
+        self.bucket = None
+
+    def create(self, settings, t):
+        self.close()
+        self.settings = settings
+        with open(self.path + ".new", 'wb') as log_file:
+            log_file.write(self.settingsLine(settings))
+        os.replace(self.path + ".new", self.path)
+        self.setoff = 0
+        self.bucket = None
+        self.writeIndex([])
+
+    def reopen(self, settings, t):
+        # continue an existing log, add settings when they changed
+        self.close()
+        if logformat(self.path) != self.fmt:
+            self.create(settings, t)
+        else:
+            self.reindex()
+            if self.settingsLine(settings) != self.settingsLine(self.settings if self.settings else {}):
+                self.segment(settings, t)
+
+    def segment(self, settings, t):
+        self.settings = settings
+        log_file = self.getHandle()
+        self.setoff = log_file.tell()
+        log_file.write(self.settingsLine(settings))
+        self.bucket = None
+
+    def write(self, row):
+        log_file = self.getHandle()
+        off = log_file.tell()
+        log_file.write((", ".join(str(val) for val in row) + "\n").encode(ENCODING))
+        bucket = int(row[0] // self.indexStep(self.settings))
+        if bucket != self.bucket:
+            self.bucket = bucket
+            try:
+                with open(self.idxpath, 'a') as idx_file:
+                    idx_file.write("{}, {}, {}\n".format(row[0], self.setoff, off))
+            except OSError:
+                pass
+
+    def trimStart(self, cutoff):
+        """
+        Finds the first row at or after cutoff from the index entry before
+        it, so at most an index bucket is parsed. The settings line in
+        effect there becomes the head of the trimmed log.
+        """
+        size = os.path.getsize(self.path)
+        setoff = 0
+        off = None
+        for t, soff, roff in self.readIndex():
+            if t > cutoff or roff >= size or soff >= size:
+                break
+            setoff, off = soff, roff
+        if off == None:
+            return None
+        oldest = None
+        with open(self.path, 'rb') as log_file:
+            log_file.seek(setoff)
+            head = log_file.readline()
+            if not head.endswith(b"\n"):
+                return None
+            log_file.seek(off)
+            for line in log_file:
+                if not line.endswith(b"\n"):
+                    break
+                content = line.decode(ENCODING).split(",")
+                if len(content) == 3:
+                    head = line
+                else:
+                    row = self.parseSample(content)
+                    if row and row[0] >= cutoff:
+                        oldest = row[0]
+                        break
+                off += len(line)
+        if off <= len(head):
+            return None
+        return head, off, oldest if oldest != None else cutoff, (off, len(head), oldest)
+
+    def trimDone(self, state):
+        # offsets from the cut on move to after the head, the first row kept
+        # starts an index bucket
+        cut, headlen, oldest = state
+        shift = cut - headlen
+        entries = [(t, soff - shift if soff >= cut else 0, roff - shift)
+                   for t, soff, roff in self.readIndex() if roff >= cut]
+        if oldest != None and (not entries or entries[0][2] != headlen):
+            entries.insert(0, (oldest, 0, headlen))
+        self.writeIndex(entries)
+        self.setoff = self.setoff - shift if self.setoff >= cut else 0
+
+    def rows(self, since = None, offset = None):
+        """
+        Generator of ("settings", dict) and ("data", row), starting at
+        offset or at the index entry before since.
+        """
+        try:
+            with open(self.path, 'rb') as log_file:
+                st = os.fstat(log_file.fileno())
+                self.ino = st.st_ino
+                self.offset = 0
+                start = self.seek(since, st.st_size, offset)
+                if start:
+                    setoff, self.offset = start
+                    log_file.seek(setoff)
+                    line = log_file.readline()
+                    if not line.endswith(b"\n"):
+                        return # still being written
+                    yield "settings", self.parseSettings(line.decode(ENCODING).split(","))
+                    log_file.seek(self.offset)
+                for line in log_file:
+                    if not line.endswith(b"\n"):
+                        break # still being written
+                    self.offset += len(line)
+                    content = line.decode(ENCODING).split(",")
+                    if len(content) == 3:
+                        yield "settings", self.parseSettings(content)
+                    else:
+                        row = self.parseSample(content)
+                        if row:
+                            yield "data", row
+        except (OSError, UnicodeDecodeError):
+            pass
+
+    def normalize(self, settings):
+        return self.parseSettings(self.settingsLine(settings).decode(ENCODING).split(","))
+
+################## INTERNAL FUNCTIONS ###################
+
+    def settingsLine(self, settings):
+        isettings = [] #ctrl(s), farenheit, interval
+        isettings.append(" ".join(logchannels(settings)))
+        isettings.append("F" if settings.get("farenheit") else "C")
+        isettings.append(str(settings.get("interval", 0)))
+        return (", ".join(isettings) + "\n").encode(ENCODING)
+
+    def parseSettings(self, isettings):
+        settings = {}
+        channels = isettings[0].split()
+        settings["fancontrol"] = channels[0] if channels else ""
+        if len(channels) > 1:
+            settings["channels"] = channels
+        settings["farenheit"] = (isettings[1].strip() == "F")
+        try:
+            settings["interval"] = number(isettings[2])
+        except:
+            settings["interval"] = 0
+        return settings
+
+    def parseSample(self, content):
+        # numbers, except for the alarm texts
+        row = None
+        if len(content) >= 1 + ROW_CHANNEL:
+            try:
+                row = (number(content[0]),)
+                for val in content[1:]:
+                    try:
+                        row += (number(val),)
+                    except ValueError:
+                        row += (val.strip(),)
+            except ValueError:
+                row = None
+        return row
+
+    def indexStep(self, settings):
+        # about LOG_INDEXROWS rows per bucket, at least LOG_INDEXSTEP
+        try:
+            return max(LOG_INDEXSTEP, LOG_INDEXROWS * float(settings.get("interval", 0)))
+        except:
+            return LOG_INDEXSTEP
+
+    def seek(self, since, size, offset = None):
+        # last index entry at or before since, entries past the end are stale.
+        # At an offset, the settings of the last entry before it are used
+        start = None
+        if offset != None:
+            start = 0, offset
+            for t, setoff, off in self.readIndex():
+                if off > offset or off >= size:
+                    break
+                start = setoff, offset
+        elif since != None:
+            for t, setoff, off in self.readIndex():
+                if t > since or off >= size or setoff >= size:
+                    break
+                start = setoff, off
+        return start
+
+    def readIndex(self):
+        entries = []
+        try:
+            with open(self.idxpath, 'r') as idx_file:
+                for line in idx_file:
+                    try:
+                        t, setoff, off = line.split(",")
+                        entries.append((number(t), int(setoff), int(off)))
+                    except ValueError:
+                        pass
+        except OSError:
+            pass
+        return entries
+
+    def writeIndex(self, entries):
+        try:
+            with open(self.idxpath, 'w') as idx_file:
+                for entry in entries:
+                    idx_file.write("{}, {}, {}\n".format(*entry))
+        except OSError:
+            pass
+
+    def reindex(self):
+        # rebuild the index from the log, also gets the last settings
+        entries = []
+        settings = None
+        self.setoff = 0
+        self.bucket = None
+        try:
+            with open(self.path, 'rb') as log_file:
+                off = 0
+                for line in log_file:
+                    content = line.decode(ENCODING).split(",")
+                    if len(content) == 3:
+                        settings = self.parseSettings(content)
+                        self.setoff = off
+                        self.bucket = None
+                    else:
+                        row = self.parseSample(content)
+                        if row:
+                            bucket = int(row[0] // self.indexStep(settings if settings else {}))
+                            if bucket != self.bucket:
+                                self.bucket = bucket
+                                entries.append((row[0], self.setoff, off))
+                    off += len(line)
+        except (OSError, UnicodeDecodeError):
+            pass
+        self.settings = settings
+        self.writeIndex(entries)
+
+#########################################################
+# Class : binlog                                        #
+#########################################################
+class binlog(logfile):
+    """
+    Binary log: a file header followed by segments. A segment header holds
+    the base time, the number of records (SEG_OPEN while it is still being
+    appended to) and the settings as JSON. Records have a fixed width:
+    the time delta to the base in ms and per channel the temperature in
+    milli-degrees, rpm, pwm and an alarm code (and their min/max if the
+    settings mark the segment as aggregated, or the jitter in us if the
+    settings mark it with jitter). Readers mmap the file and
+    decode whole segments with struct.iter_unpack.
+    """
+    def __init__(self, path, sync = LOG_SYNC_NONE):
+        super(binlog, self).__init__(path, sync)
+        self.fmt = LOG_BINARY
+        self.segoff = -1
+        self.seglen = 0
+        self.base = 0
+        self.rec = self.getRecord({})
+
+    def create(self, settings, t):
+        self.close()
+        with open(self.path + ".new", 'wb') as log_file:
+            log_file.write(BIN_HEADER.pack(BIN_MAGIC, BIN_VERSION, 0))
+        os.replace(self.path + ".new", self.path)
+        self.segoff = -1
+        self.segment(settings, t)
+
+    def reopen(self, settings, t):
+        # continue the last segment if the settings are equal, otherwise
+        # close it and add a new segment
+        self.close()
+        last = None
+        try:
+            with open(self.path, 'r+b') as log_file:
+                size = os.fstat(log_file.fileno()).st_size
+                magic, version, reserved = BIN_HEADER.unpack(log_file.read(BIN_HEADER.size))
+                if magic == BIN_MAGIC and version == BIN_VERSION:
+                    with mmap.mmap(log_file.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+                        for last in self.segments(mm, BIN_HEADER.size, size):
+                            pass
+                if last:
+                    lsettings, base, start, end, rec, segoff = last
+                    log_file.truncate(end)
+                    self.settings = lsettings
+                    self.segoff = segoff
+                    self.seglen = start - segoff - SEG_HEADER.size
+                    self.base = base
+                    self.rec = rec
+        except:
+            last = None
+        if not last:
+            self.create(settings, t)
+        elif settings != self.settings:
+            self.segment(settings, t)
+
+    def segment(self, settings, t):
+        # close the current segment and start a new one at t
+        self.close()
+        ms = int(t) * 1000
+        data = json.dumps(settings).encode(ENCODING)
+        with open(self.path, 'r+b') as log_file:
+            log_file.seek(0, os.SEEK_END)
+            end = log_file.tell()
+            # the count of the closed segment is in its own record size
+            self.closeSegment(log_file, end)
+            log_file.write(SEG_HEADER.pack(SEG_MAGIC, ms, SEG_OPEN, len(data)))
+            log_file.write(data.ljust(self.padded(len(data)), b"\0"))
+        self.settings = settings
+        self.rec = self.getRecord(settings)
+        self.segoff = end
+        self.seglen = len(data)
+        self.base = ms
+
+    def write(self, row):
+        ms = int(round(row[0] * 1000))
+        if (ms < self.base) or (ms - self.base > SEG_MAXDELTA):
+            self.segment(self.settings, row[0])
+        t, channels, jitter = splitrow(row, len(logchannels(self.settings)))
+        values = [ms - self.base]
+        for ch in channels:
+            values.extend([milli(ch[0]), u16(ch[1]), u8(ch[2]), alarmcode(ch[3])])
+            if self.settings.get("aggregate"):
+                values.extend([milli(ch[4]), milli(ch[5]), u16(ch[6]), u16(ch[7]), u8(ch[8]), u8(ch[9])])
+        if self.settings.get("jitter") and not self.settings.get("aggregate"):
+            values.append(milli(jitter) if jitter != None else 0)
+        self.getHandle().write(self.rec.pack(*values))
+
+    def rows(self, since = None, offset = None):
+        """
+        Generator of ("settings", dict) and ("data", row). Records are
+        fixed width and in time order, so segments before since or offset
+        are skipped and the first record is found by bisection.
+        """
+        try:
+            with open(self.path, 'rb') as log_file:
+                st = os.fstat(log_file.fileno())
+                size = st.st_size
+                self.ino = st.st_ino
+                self.offset = BIN_HEADER.size
+                if size <= BIN_HEADER.size:
+                    return
+                with mmap.mmap(log_file.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+                    magic, version, reserved = BIN_HEADER.unpack_from(mm, 0)
+                    if magic != BIN_MAGIC or version != BIN_VERSION:
+                        return
+                    for settings, base, start, end, rec, segoff in self.segments(mm, BIN_HEADER.size, size):
+                        if offset != None:
+                            if end <= offset:
+                                continue
+                            start = max(start, start + ((offset - start) // rec.size) * rec.size)
+                        elif since != None:
+                            start = self.bisect(mm, base, start, end, rec, since)
+                        self.offset = start
+                        yield "settings", settings
+                        view = memoryview(mm)[start:end]
+                        try:
+                            n = len(logchannels(settings))
+                            aggregate = bool(settings.get("aggregate"))
+                            for values in rec.iter_unpack(view):
+                                self.offset += rec.size
+                                yield "data", self.decode(base, values, n, aggregate)
+                        finally:
+                            view.release()
+        except (OSError, ValueError):
+            pass
+
+################## INTERNAL FUNCTIONS ###################
+
+    def getRecord(self, settings):
+        fmt = REC_CHANNEL
+        if settings.get("aggregate"):
+            fmt += REC_AGGREGATE
+        fmt = REC_TIME + fmt * len(logchannels(settings))
+        if settings.get("jitter") and not settings.get("aggregate"):
+            fmt += REC_JITTER
+        return struct.Struct("<" + fmt)
+
+    def decode(self, base, values, n = 1, aggregate = False):
+        row = (mstime(base + values[0]),)
+        i = 1
+        for ch in range(n):
+            row += (mstime(values[i]), values[i + 1], values[i + 2], alarmtext(values[i + 3]))
+            i += 4
+            if aggregate:
+                tmin, tmax, rmin, rmax, pmin, pmax = values[i:i + 6]
+                row += (mstime(tmin), mstime(tmax), rmin, rmax, pmin, pmax)
+                i += 6
+        if i < len(values):
+            row += (mstime(values[i]),)
+        return row
+
+    def segments(self, mm, off, size):
+        while off + SEG_HEADER.size <= size:
+            magic, base, count, jlen = SEG_HEADER.unpack_from(mm, off)
+            if magic != SEG_MAGIC:
+                break
+            segoff = off
+            off += SEG_HEADER.size
+            settings = json.loads(bytes(mm[off:off + jlen]).decode(ENCODING))
+            off += self.padded(jlen)
+            rec = self.getRecord(settings)
+            if count == SEG_OPEN:
+                count = (size - off) // rec.size
+            end = min(off + count * rec.size, off + ((size - off) // rec.size) * rec.size)
+            yield settings, base, off, end, rec, segoff
+            off = end
+
+    def bisect(self, mm, base, start, end, rec, since):
+        # offset of the first record at or after since
+        ms = int(round(since * 1000)) - base
+        lo = 0
+        hi = (end - start) // rec.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if struct.unpack_from("<" + REC_TIME, mm, start + mid * rec.size)[0] < ms:
+                lo = mid + 1
+            else:
+                hi = mid
+        return start + lo * rec.size
+
+    def trimStart(self, cutoff):
+        """
+        Finds the first record at or after cutoff by bisection. The header
+        of its segment, with the count of the records that are kept,
+        becomes the head of the trimmed log.
+        """
+        with open(self.path, 'rb') as log_file:
+            size = os.fstat(log_file.fileno()).st_size
+            if size <= BIN_HEADER.size:
+                return None
+            with mmap.mmap(log_file.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+                magic, version, reserved = BIN_HEADER.unpack_from(mm, 0)
+                if magic != BIN_MAGIC or version != BIN_VERSION:
+                    return None
+                found = None
+                for settings, base, start, end, rec, segoff in self.segments(mm, BIN_HEADER.size, size):
+                    found = settings, base, start, end, rec, segoff, self.bisect(mm, base, start, end, rec, cutoff)
+                    if found[6] < end:
+                        break
+                if not found:
+                    return None
+                settings, base, start, end, rec, segoff, off = found
+                if segoff == BIN_HEADER.size and off == start:
+                    return None
+                magic, base, count, jlen = SEG_HEADER.unpack_from(mm, segoff)
+                if count != SEG_OPEN:
+                    count -= (off - start) // rec.size
+                oldest = cutoff
+                if off < end:
+                    oldest = mstime(base + struct.unpack_from("<" + REC_TIME, mm, off)[0])
+                head = BIN_HEADER.pack(BIN_MAGIC, BIN_VERSION, 0) + SEG_HEADER.pack(SEG_MAGIC, base, count, jlen) + \
+                       bytes(mm[segoff + SEG_HEADER.size:start])
+        return head, off, oldest, self.segoff
+
+    def trimValid(self, state):
+        # a segment that was closed meanwhile has its count in the old file
+        return state == self.segoff
+
+    def trimDone(self, state):
+        # continue the open segment of the trimmed log
+        self.reopen(self.settings, time.time())
+
+    def closeSegment(self, log_file, end):
+        if self.segoff >= 0:
+            start = self.segoff + SEG_HEADER.size + self.padded(self.seglen)
+            log_file.seek(self.segoff + 12)
+            log_file.write(struct.pack("<I", (end - start) // self.rec.size))
+            log_file.seek(end)
+
+    def padded(self, length):
+        return (length + 7) & ~7
+
+#########################################################
+# Class : logbucket                                     #
+#########################################################
+class logbucket(object):
+    """
+    Aggregates rows of n channels into buckets of step seconds from
+    origin. A finished bucket is a single row with per channel the average
+    values, the combined alarms and the min/max values (of the min/max of
+    already aggregated rows).
+    """
+    def __init__(self, step, origin = 0, n = 1):
+        self.step = step
+        self.origin = origin
+        self.n = n
+        self.bucket = None
+        self.reset()
+
+    def __del__(self):
+        pass
+
+    def reset(self):
+        self.count = [0] * self.n
+        self.sums = [[0, 0, 0] for ch in range(self.n)]
+        self.mins = [[None, None, None] for ch in range(self.n)]
+        self.maxs = [[None, None, None] for ch in range(self.n)]
+        self.alarm = [0] * self.n
+
+    def add(self, row):
+        """
+        Adds a row, returns the previous bucket row when it is finished.
+        """
+        finished = None
+        bucket = self.origin + int((row[0] - self.origin) // self.step) * self.step
+        if bucket != self.bucket:
+            finished = self.flush()
+            self.bucket = bucket
+        t, channels, jitter = splitrow(row, self.n)
+        for ch, values in enumerate(channels):
+            if values[3] == ALARM_NOK:
+                continue
+            self.count[ch] += 1
+            aggregated = len(values) >= ROW_AGGREGATE
+            sums, mins, maxs = self.sums[ch], self.mins[ch], self.maxs[ch]
+            for i in range(3):
+                val = values[i]
+                sums[i] += val
+                vmin = values[4 + 2 * i] if aggregated else val
+                vmax = values[5 + 2 * i] if aggregated else val
+                if mins[i] == None or vmin < mins[i]:
+                    mins[i] = vmin
+                if maxs[i] == None or vmax > maxs[i]:
+                    maxs[i] = vmax
+            self.alarm[ch] |= alarmcode(values[3])
+        return finished
+
+    def state(self):
+        # the bucket that is being filled, to continue it with restore()
+        return {"step": self.step, "origin": self.origin, "n": self.n, "bucket": self.bucket,
+                "count": self.count, "sums": self.sums, "mins": self.mins, "maxs": self.maxs,
+                "alarm": self.alarm}
+
+    def restore(self, state):
+        self.step = state["step"]
+        self.origin = state["origin"]
+        self.n = state["n"]
+        self.bucket = state["bucket"]
+        self.count = list(state["count"])
+        self.sums = [list(val) for val in state["sums"]]
+        self.mins = [list(val) for val in state["mins"]]
+        self.maxs = [list(val) for val in state["maxs"]]
+        self.alarm = list(state["alarm"])
+
+    def flush(self):
+        row = None
+        if any(self.count):
+            channels = []
+            for ch in range(self.n):
+                count = self.count[ch]
+                if count:
+                    sums, mins, maxs = self.sums[ch], self.mins[ch], self.maxs[ch]
+                    channels.append((round(sums[0] / count, 3), int(round(sums[1] / count)),
+                                     int(round(sums[2] / count)), alarmtext(self.alarm[ch]),
+                                     mins[0], maxs[0], mins[1], maxs[1], mins[2], maxs[2]))
+                else:
+                    channels.append((0, 0, 0, ALARM_NOK, 0, 0, 0, 0, 0, 0))
+            row = joinrow(self.bucket, channels)
+        self.reset()
+        return row
+
+#########################################################
+# Class : logtier                                       #
+#########################################################
+class logtier(logbucket):
+    """
+    Retention tier, every finished bucket is written to the tier log.
+    settings are the settings of the tier log.
+    """
+    def __init__(self, name, step, keep, log, n = 1, settings = {}):
+        self.name = name
+        self.keep = keep
+        self.log = log
+        self.settings = settings
+        super(logtier, self).__init__(step, 0, n)
+
+    def add(self, row):
+        finished = super(logtier, self).add(row)
+        if finished:
+            self.log.write(finished)
+
+    def flush(self):
+        finished = super(logtier, self).flush()
+        if finished:
+            self.log.write(finished)
+
+#########################################################
+# Class : logretention                                  #
+#########################################################
+class logretention(object):
+    """
+    Round-robin retention over LOG_TIERS. Raw samples go to the data log,
+    every aggregate tier is fed incrementally from the same samples. All
+    files are kept across logger restarts and reloads, changed settings
+    start a new segment. Each file is trimmed to its retention once it is
+    LOG_SLACK over it, so disk usage and read cost stay bounded. Trimming
+    is incremental, one log at a time and at most LOG_TRIMCHUNK bytes per
+    sample, so a sample is never delayed by a full rewrite.
+    Raw rows are buffered in memory (at most LOG_BUFFERMAX) and written
+    behind, after count rows, when the oldest is age seconds old and on
+    close(). Until then they are in a buffer file in LOG_RUNFOLDER (tmpfs),
+    where readers find them.
+    The buckets of the tiers that are not finished on close() are kept in
+    a file next to their log (log + LOG_BUCKETEXT) and continued by open(),
+    so a restart does not write a partial bucket twice. On a reload they
+    are handed over in memory instead.
+    """
+    def __init__(self, path = None, fmt = LOG_TEXT, sync = LOG_SYNC_NONE, age = LOG_FLUSHAGE, count = LOG_FLUSHCOUNT):
+        self.path = path if path else LOG_FILENAME
+        self.fmt = fmt
+        self.sync = sync
+        self.age = age
+        self.count = count
+        self.raw = None
+        self.tiers = []
+        self.oldest = {}
+        self.trimming = None
+        self.buffer = collections.deque(maxlen = LOG_BUFFERMAX)
+        self.first = 0
+        self.side = None
+
+    def __del__(self):
+        pass
+
+    def open(self, settings, t, buckets = None):
+        # continue the logs, settings that changed start a new segment.
+        # buckets are returned by close(), otherwise they are loaded
+        self.raw = openlog(self.path, self.fmt, self.sync)
+        self.raw.reopen(settings, t)
+        self.oldest = {self.raw.path: self.raw.oldest()}
+        self.tiers = []
+        for name, step, keep in LOG_TIERS:
+            if step:
+                tsettings = dict(settings)
+                tsettings.pop("jitter", None)
+                tsettings["interval"] = step
+                tsettings["aggregate"] = step
+                log = openlog(tierpath(name, self.path), self.fmt, self.sync)
+                tier = logtier(name, step, keep, log, len(logchannels(settings)), tsettings)
+                self.resume(tier, t, buckets)
+                log.reopen(tsettings, int(t // step) * step)
+                self.tiers.append(tier)
+                self.oldest[log.path] = log.oldest()
+        self.buffer.clear()
+        self.openBuffer()
+
+    def append(self, t, samples, jitter = None):
+        row = samplerow(t, samples, jitter)
+        if not self.buffer:
+            self.first = time.monotonic()
+        self.buffer.append(row)
+        self.writeBuffer(row)
+        for tier in self.tiers:
+            tier.add(row)
+        if (self.sync == LOG_SYNC_ALWAYS) or (len(self.buffer) >= self.count) or \
+           (time.monotonic() - self.first >= self.age):
+            self.flush()
+        self.trim(t)
+
+    def flush(self):
+        """
+        Writes the buffered rows behind to the log files.
+        """
+        while self.buffer:
+            self.raw.write(self.buffer[0])
+            self.buffer.popleft()
+        self.raw.flush()
+        for tier in self.tiers:
+            tier.log.flush()
+        self.openBuffer()
+
+    def close(self, persist = True):
+        """
+        Returns the unfinished tier buckets {path: state} for open(), they
+        are not written. With persist they are saved next to their log.
+        """
+        buckets = {}
+        try:
+            self.flush()
+        finally:
+            for tier in self.tiers:
+                if any(tier.count):
+                    buckets[tier.log.path] = self.getBucket(tier)
+                    if persist:
+                        self.saveBucket(tier)
+            for log in [self.raw] + [tier.log for tier in self.tiers]:
+                log.cancelTrim()
+                log.close()
+            self.trimming = None
+            self.closeBuffer(True)
+        return buckets
+
+################## INTERNAL FUNCTIONS ###################
+
+    def resume(self, tier, t, buckets = None):
+        """
+        Continues the bucket of the tier that was not finished on close().
+        If the settings changed, it is finished and written to the segment
+        of its own settings, before the new settings start a segment.
+        """
+        if buckets != None:
+            state = buckets.get(tier.log.path)
+        else:
+            state = self.loadBucket(tier.log.path)
+        if state:
+            try:
+                if state["settings"] == tier.settings:
+                    tier.restore(state)
+                else:
+                    old = logtier(tier.name, tier.step, tier.keep, tier.log, state["n"], state["settings"])
+                    old.restore(state)
+                    tier.log.reopen(state["settings"], old.bucket)
+                    old.flush()
+            except (KeyError, TypeError, ValueError):
+                tier.reset()
+
+    def getBucket(self, tier):
+        state = tier.state()
+        state["settings"] = tier.settings
+        return state
+
+    def saveBucket(self, tier):
+        path = tier.log.path + LOG_BUCKETEXT
+        try:
+            with open(path + ".new", 'w') as bucket_file:
+                json.dump(self.getBucket(tier), bucket_file)
+            os.replace(path + ".new", path)
+        except OSError:
+            # write it partial rather than lose it
+            tier.flush()
+
+    def loadBucket(self, path):
+        # the bucket of the tier log at path, the file is removed
+        state = None
+        path += LOG_BUCKETEXT
+        try:
+            with open(path, 'r') as bucket_file:
+                state = json.load(bucket_file)
+            os.unlink(path)
+        except (OSError, ValueError):
+            state = None
+        return state
+
+    def trim(self, t):
+        if self.trimming:
+            log, keep = self.trimming
+            done, oldest = log.trimStep()
+            if done:
+                self.trimming = None
+                # when cancelled, try again once LOG_SLACK over retention again
+                self.oldest[log.path] = oldest if oldest != None else t - keep
+            return
+        logs = [(self.raw, LOG_TIERS[0][2])] + [(tier.log, tier.keep) for tier in self.tiers]
+        for log, keep in logs:
+            oldest = self.oldest.get(log.path)
+            if oldest == None:
+                self.oldest[log.path] = t
+            elif t - oldest > keep * (1 + LOG_SLACK):
+                if log.startTrim(t - keep):
+                    self.trimming = log, keep
+                    return
+                self.oldest[log.path] = t - keep
+
+    def openBuffer(self):
+        # (re)starts the buffer file with the settings of the raw log
+        try:
+            if not self.side:
+                if not os.path.isdir(LOG_RUNFOLDER):
+                    os.makedirs(LOG_RUNFOLDER, 0o755)
+                self.side = open(bufferpath(self.path), 'w')
+            self.side.seek(0)
+            self.side.truncate()
+            self.side.write(json.dumps({"path": self.raw.path, "settings": self.raw.settings}) + "\n")
+            self.side.flush()
+        except OSError:
+            self.closeBuffer()
+
+    def writeBuffer(self, row):
+        if self.side:
+            try:
+                self.side.write(json.dumps(row) + "\n")
+                self.side.flush()
+            except OSError:
+                self.closeBuffer()
+
+    def closeBuffer(self, remove = False):
+        if self.side:
+            try:
+                self.side.close()
+            except OSError:
+                pass
+            self.side = None
+        if remove:
+            try:
+                os.unlink(bufferpath(self.path))
+            except OSError:
+                pass
+
+#########################################################
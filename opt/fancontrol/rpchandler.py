@@ -0,0 +1,375 @@
+#!/usr/bin/python3
+
+# -*- coding: utf-8 -*-
+#########################################################
+# SERVICE : rpchandler.py                               #
+#           JSON-lines RPC over a unix socket to keep   #
+#           fancontrol data warm between cli calls.     #
+#           I. Helwegen 2023                            #
+#########################################################
+
+####################### IMPORTS #########################
+import os
+import json
+import socket
+import signal
+import selectors
+from datahandler import datahandler
+#########################################################
+
+####################### GLOBALS #########################
+RPC_FOLDER    = "/run/fancontrol"
+RPC_SOCKET    = "/run/fancontrol/fancontrol.sock"
+RPC_TIMEOUT   = 2
+RPC_BACKLOG   = 8
+RPC_BUFSIZE   = 65536
+RPC_MAXLINE   = 1048576
+RPC_METHODS   = ["monitor", "snapshot", "getControls", "getTempSensors", "getFanInputs",
+                 "getPWMs", "getHwMon", "get", "gen", "all", "alarms"]
+RPC_SUBSCRIBE = "watchAlarms"
+ENCODING      = 'utf-8'
+#########################################################
+
+###################### FUNCTIONS ########################
+
+#########################################################
+# Class : rpcmethods                                    #
+#########################################################
+class rpcmethods(object):
+    """
+    Read-only fccli verbs on a single datahandler.
+    With watch set, the datahandler is kept warm and only reloaded when
+    one of the configuration files changed on disk.
+    """
+    def __init__(self, watch = False):
+        self.db = None
+        self.watch = watch
+        self.stamp = None
+
+    def __del__(self):
+        pass
+
+    def __call__(self, method, params = []):
+        if not method in RPC_METHODS:
+            raise ValueError("Unknown method: {}".format(method))
+        self.getDb()
+        return getattr(self, method)(*params)
+
+    def monitor(self, ctrl = None):
+        return self.db.monitor(ctrl)
+
+    def snapshot(self):
+        return self.db.snapshot()
+
+    def getControls(self):
+        return self.db.getControls()
+
+    def getTempSensors(self):
+        return self.db.getTempSensors()
+
+    def getFanInputs(self):
+        return self.db.getFanInputs()
+
+    def getPWMs(self):
+        return self.db.getPWMs()
+
+    def getHwMon(self, hwmon = None):
+        if hwmon == None:
+            fans = self.db.getControls()
+            if fans:
+                hwmon = list(fans.keys())[0].split("/")[0]
+        return self.db.getHwMon(hwmon)
+
+    def get(self, fan = None):
+        data = {}
+        if fan:
+            if "fans" in self.db():
+                for lfan in self.db()["fans"]:
+                    if lfan == fan:
+                        data = self.db()["fans"][lfan]
+        else:
+            data = self.db()
+        return data
+
+    def gen(self):
+        data = dict(self.db())
+        if "fans" in data:
+            del data["fans"]
+        return data
+
+    def all(self):
+        data = {}
+        data["farenheit"] = self.db()['farenheit']
+        data["ctrls"] = self.db.getControls()
+        data["temps"] = self.db.getTempSensors()
+        data["rpms"] = self.db.getFanInputs()
+        data["pwms"] = self.db.getPWMs()
+        return data
+
+    def alarms(self):
+        return self.db.getAlarmState()
+
+    def watchAlarms(self):
+        self.getDb()
+        return self.db.watchAlarms()
+
+    def pollAlarms(self):
+        self.getDb()
+        self.db.pollAlarms()
+        return self.db.getTransitions()
+
+################## INTERNAL FUNCTIONS ###################
+
+    def getDb(self):
+        if not self.db:
+            self.db = datahandler()
+            self.stamp = self.db.getStamp()
+        elif self.watch:
+            stamp = self.db.getStamp()
+            if stamp != self.stamp:
+                self.db.reload()
+                self.stamp = stamp
+
+#########################################################
+# Class : rpcserver                                     #
+#########################################################
+class rpcserver(object):
+    """
+    Serves rpcmethods to JSON-lines requests. A "watchAlarms" request
+    answers with the current alarms and keeps the connection subscribed:
+    every alarm change is pushed to it as {"alarms": {ctrl: alarm}}.
+    """
+    def __init__(self, path = None):
+        self.path = path if path else RPC_SOCKET
+        self.methods = rpcmethods(True)
+        self.alarms = None
+        self.subscribers = set()
+        self.sel = None
+        self.sock = None
+        self.running = False
+
+    def __del__(self):
+        pass
+
+    def serve(self):
+        signal.signal(signal.SIGINT, self._sigterm_handler)
+        signal.signal(signal.SIGTERM, self._sigterm_handler)
+        self.open()
+        self.running = True
+        try:
+            while self.running:
+                for key, mask in self.sel.select(timeout = 1):
+                    if key.data == None:
+                        self.accept()
+                    elif key.fileobj is not self.alarms:
+                        self.receive(key.fileobj, key.data)
+                # signalled alarms, or all alarms when it is time to re-read them
+                self.pollAlarms()
+        finally:
+            self.close()
+
+################## INTERNAL FUNCTIONS ###################
+
+    def _sigterm_handler(self, signum, frame):
+        self.running = False
+
+    def open(self):
+        folder = os.path.dirname(self.path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder, 0o755)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        oldmask = os.umask(0o077)
+        try:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(self.path)
+            self.sock.listen(RPC_BACKLOG)
+        finally:
+            os.umask(oldmask)
+        self.sock.setblocking(False)
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.sock, selectors.EVENT_READ, None)
+        try:
+            # alarms are kept in memory and updated when signalled
+            self.alarms = self.methods.watchAlarms()
+            self.sel.register(self.alarms, selectors.EVENT_READ, False)
+            self.pollAlarms()
+        except (Exception, SystemExit):
+            self.alarms = None
+
+    def close(self):
+        if self.sel:
+            for key in list(self.sel.get_map().values()):
+                if key.fileobj is not self.alarms:
+                    key.fileobj.close()
+            self.sel.close()
+            self.sel = None
+        self.sock = None
+        self.alarms = None
+        self.subscribers = set()
+        try:
+            os.unlink(self.path)
+        except:
+            pass
+
+    def accept(self):
+        try:
+            conn, addr = self.sock.accept()
+            conn.setblocking(False)
+            self.sel.register(conn, selectors.EVENT_READ, bytearray())
+        except OSError:
+            pass
+
+    def pollAlarms(self):
+        if self.alarms:
+            try:
+                transitions = self.methods.pollAlarms()
+            except (Exception, SystemExit):
+                # stop waiting on them, they are watched again on the next poll
+                self.alarms.clear()
+                transitions = {}
+            if transitions:
+                self.push({"alarms": transitions})
+
+    def subscribe(self, conn, response):
+        if self.alarms:
+            self.subscribers.add(conn)
+        else:
+            del response["result"]
+            response["error"] = "Alarms are not watched"
+
+    def push(self, message):
+        for conn in list(self.subscribers):
+            if not self.respond(conn, message):
+                self.drop(conn)
+
+    def drop(self, conn):
+        self.subscribers.discard(conn)
+        self.sel.unregister(conn)
+        conn.close()
+
+    def receive(self, conn, buf):
+        try:
+            data = conn.recv(RPC_BUFSIZE)
+        except OSError:
+            data = b""
+        if not data:
+            self.drop(conn)
+            return
+        buf.extend(data)
+        while True:
+            pos = buf.find(b"\n")
+            if pos < 0:
+                break
+            line = bytes(buf[:pos])
+            del buf[:pos + 1]
+            if line.strip():
+                if not self.respond(conn, self.handle(conn, line)):
+                    self.drop(conn)
+                    return
+        if len(buf) > RPC_MAXLINE:
+            self.drop(conn)
+
+    def handle(self, conn, line):
+        response = {"id": None}
+        try:
+            request = json.loads(line.decode(ENCODING))
+            response["id"] = request.get("id")
+            params = request.get("params", [])
+            if not isinstance(params, list):
+                params = [params]
+            if request.get("method") == RPC_SUBSCRIBE:
+                response["result"] = self.methods("alarms", params)
+                self.subscribe(conn, response)
+            else:
+                response["result"] = self.methods(request.get("method"), params)
+        except (Exception, SystemExit) as e:
+            response["error"] = str(e)
+        return response
+
+    def respond(self, conn, response):
+        retval = True
+        try:
+            conn.setblocking(True)
+            conn.settimeout(RPC_TIMEOUT)
+            conn.sendall((json.dumps(response) + "\n").encode(ENCODING))
+            conn.setblocking(False)
+        except OSError:
+            retval = False
+        return retval
+
+#########################################################
+# Class : rpcclient                                     #
+#########################################################
+class rpcclient(object):
+    def __init__(self, path = None, timeout = RPC_TIMEOUT):
+        self.path = path if path else RPC_SOCKET
+        self.timeout = timeout
+
+    def __del__(self):
+        pass
+
+    def available(self):
+        return os.path.exists(self.path)
+
+    def call(self, method, *params):
+        """
+        Returns (True, result) when the server answered, (False, None) when
+        it is not running or failed, so the caller can fall back to local.
+        """
+        retval = False, None
+        if not self.available():
+            return retval
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout)
+                sock.connect(self.path)
+                request = {"id": 1, "method": method, "params": list(params)}
+                sock.sendall((json.dumps(request) + "\n").encode(ENCODING))
+                buf = bytearray()
+                while not b"\n" in buf:
+                    data = sock.recv(RPC_BUFSIZE)
+                    if not data:
+                        break
+                    buf.extend(data)
+            response = json.loads(buf.decode(ENCODING))
+            if "result" in response:
+                retval = True, response["result"]
+        except:
+            pass
+        return retval
+
+    def watchAlarms(self):
+        """
+        Yields the {ctrl: alarm} of all fan controls first and then the
+        changed ones as they are pushed, until the server goes away.
+        """
+        if not self.available():
+            return
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout)
+                sock.connect(self.path)
+                request = {"id": 1, "method": RPC_SUBSCRIBE, "params": []}
+                sock.sendall((json.dumps(request) + "\n").encode(ENCODING))
+                sock.settimeout(None)
+                buf = bytearray()
+                while True:
+                    data = sock.recv(RPC_BUFSIZE)
+                    if not data:
+                        break
+                    buf.extend(data)
+                    while b"\n" in buf:
+                        pos = buf.find(b"\n")
+                        response = json.loads(bytes(buf[:pos]).decode(ENCODING))
+                        del buf[:pos + 1]
+                        if "result" in response:
+                            yield response["result"]
+                        elif "alarms" in response:
+                            yield response["alarms"]
+                        else:
+                            return
+        except (OSError, ValueError):
+            pass
+
+#########################################################